@@ -1,29 +1,40 @@
 import pyaudio
 import asyncio
+import logging
 import websockets
 import time
+import numpy as np
 from typing import Optional
 
+log = logging.getLogger(__name__)
+
 # 导入小车端配置 (假设 config.py 已经定义)
 try:
     from car.config import AUDIO_CHUNK_SIZE, AUDIO_FORMAT, AUDIO_CHANNELS, AUDIO_RATE, VAD_ENABLED
+    from car.config import AUDIO_SEND_BATCH_FRAMES, MIC_BUFFER_CHUNKS, WS_CONNECT_OPTIONS
 except ImportError:
-    print("Warning: car.config not found. Using default audio settings.")
+    log.warning("car.config not found. Using default audio settings.")
     AUDIO_CHUNK_SIZE = 1024       # 每次读取的音频帧大小 (字节)
     AUDIO_FORMAT = pyaudio.paInt16 # 16-bit PCM
     AUDIO_CHANNELS = 1             # 单声道
     AUDIO_RATE = 16000             # 16kHz 采样率
     VAD_ENABLED = False            # 默认不启用 VAD
+    AUDIO_SEND_BATCH_FRAMES = 3    # 每个 WebSocket 帧合并的音频块数
+    MIC_BUFFER_CHUNKS = 4          # PortAudio 内部缓冲区包含的音频块数
+    WS_CONNECT_OPTIONS = {"compression": None, "max_size": None, "write_limit": 2 ** 18}
 
 # 导入 VAD 模块 (如果启用)
 if VAD_ENABLED:
     try:
         from car.audio.vad import VADDetector
-        print("VAD enabled and imported.")
+        log.info("VAD enabled and imported.")
     except ImportError:
-        print("Warning: VAD is enabled in config but car.audio.vad not found. Running without VAD.")
+        log.warning("VAD is enabled in config but car.audio.vad not found. Running without VAD.")
         VAD_ENABLED = False
 
+# PyAudio 回调、VAD 与发送协程共享的环形缓冲区容量 (以音频块为单位)，约 1 秒音频
+MIC_RING_CHUNKS = 16
+
 
 class MicClient:
     """
@@ -31,23 +42,43 @@ class MicClient:
     支持可选的 VAD (语音活动检测) 以减少空闲传输。
     """
 
-    def __init__(self, websocket_url: str):
+    def __init__(self, websocket_url: str, ring_chunks: int = MIC_RING_CHUNKS,
+                 batch_frames: int = AUDIO_SEND_BATCH_FRAMES):
         self.url = websocket_url
         self.p = pyaudio.PyAudio()
         self.stream: Optional[pyaudio.Stream] = None
         self.is_recording = False
         self.vad: Optional[VADDetector] = None
+
+        # 每个音频块的采样点数 (帧数 * 声道数)
+        self.chunk_samples = AUDIO_CHUNK_SIZE * AUDIO_CHANNELS
+        # 回调线程、VAD 与发送协程共享的 int16 环形缓冲区：
+        # 回调线程只推进 _write_idx，发送协程只推进 _read_idx (均为单调递增的采样点计数)，
+        # [_read_idx, _write_idx) 区间内的数据不会被覆盖
+        ring_chunks = max(ring_chunks, batch_frames + MIC_BUFFER_CHUNKS)
+        self._ring = np.zeros(ring_chunks * self.chunk_samples, dtype=np.int16)
+        self._write_idx = 0
+        self._read_idx = 0
+        # 回调线程通过 call_soon_threadsafe 设置该事件唤醒发送协程
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._data_evt: Optional[asyncio.Event] = None
+        self.dropped_chunks = 0
+
+        # 发送批次：合并多个音频块为一个 WebSocket 帧，摊薄每帧的头部/系统调用开销
+        self.batch_frames = max(1, batch_frames)
+        self._batch_lo: Optional[int] = None  # 未发送批次的起始采样点
+        self._batch_n = 0
         
         if VAD_ENABLED:
-            # 初始化 VAD (假设 VADDetector 接收采样率和帧长)
-            self.vad = VADDetector(AUDIO_RATE, chunk_duration_ms=(AUDIO_CHUNK_SIZE * 1000) // (AUDIO_RATE * 2))
+            # VAD 帧长与音频块一致 (块时长 = 帧数 / 采样率)
+            self.vad = VADDetector(AUDIO_RATE, chunk_duration_ms=(AUDIO_CHUNK_SIZE * 1000) // AUDIO_RATE)
         
-        print(f"MicClient initialized. Target URL: {self.url}, VAD: {VAD_ENABLED}")
+        log.info("MicClient initialized. Target URL: %s, VAD: %s", self.url, VAD_ENABLED)
 
     def start_stream(self):
         """打开 PyAudio 流准备录音。"""
         if self.is_recording:
-            print("Audio stream is already open.")
+            log.info("Audio stream is already open.")
             return
 
         # 找到输入设备 (可能需要根据实际树莓派的音频设备ID进行调整)
@@ -57,11 +88,67 @@ class MicClient:
             channels=AUDIO_CHANNELS,
             rate=AUDIO_RATE,
             input=True,
-            frames_per_buffer=AUDIO_CHUNK_SIZE,
-            stream_callback=None # 使用阻塞模式读取
+            # 较大的 PortAudio 缓冲区可以吸收 GC/调度造成的停顿，回调中再切分为音频块
+            frames_per_buffer=AUDIO_CHUNK_SIZE * MIC_BUFFER_CHUNKS,
+            stream_callback=self._pa_callback, # 回调模式：由 PortAudio 线程推送数据
+            start=False # 等发送协程准备好后再启动
         )
         self.is_recording = True
-        print("PyAudio stream opened.")
+        log.info("PyAudio stream opened.")
+
+    def _pa_callback(self, in_data, frame_count, time_info, status):
+        """
+        PyAudio 回调 (运行在 PortAudio 线程)：按音频块将数据直接写入共享环形缓冲区，
+        再通过一次 call_soon_threadsafe 唤醒发送协程，不经过线程池。
+        """
+        loop, evt = self._loop, self._data_evt
+        if loop is None or evt is None:
+            return (None, pyaudio.paContinue)
+
+        samples = np.frombuffer(in_data, dtype=np.int16)
+        ring = self._ring
+        size = len(ring)
+        n = self.chunk_samples
+        w = self._write_idx
+        for off in range(0, len(samples) - n + 1, n):
+            if w + n - self._read_idx > size:
+                # 发送协程跟不上，环形缓冲区已满，丢弃该块
+                self.dropped_chunks += 1
+                continue
+            # 环形缓冲区长度是块长的整数倍，单块写入不会跨越末尾
+            pos = w % size
+            ring[pos:pos + n] = samples[off:off + n]
+            w += n
+
+        if w != self._write_idx:
+            # 数据写完后再发布写指针
+            self._write_idx = w
+            loop.call_soon_threadsafe(evt.set)
+        return (None, pyaudio.paContinue)
+
+    def _ring_payload(self, lo: int, hi: int):
+        """
+        返回环形缓冲区中 [lo, hi) 区间的采样点作为发送负载。
+        区间连续时直接返回缓冲区上的字节视图 (零拷贝)，首尾回绕时只拼接拷贝一次。
+        发送完成前 _read_idx 不前移，回调线程不会覆盖这段数据。
+        """
+        size = len(self._ring)
+        start = lo % size
+        count = hi - lo
+        if start + count <= size:
+            return self._ring[start:start + count].data.cast('B')
+        head = size - start
+        return b"".join((self._ring[start:].data.cast('B'), self._ring[:count - head].data.cast('B')))
+
+    async def _flush_batch(self, ws_conn: websockets.WebSocketClientProtocol, upto: int):
+        """将未发送批次作为一个二进制帧发送出去，并释放 upto 之前的环形缓冲区空间。"""
+        if self._batch_n:
+            lo = self._batch_lo
+            payload = self._ring_payload(lo, lo + self._batch_n * self.chunk_samples)
+            self._batch_lo = None
+            self._batch_n = 0
+            await ws_conn.send(payload)
+        self._read_idx = upto
 
     def stop_stream(self):
         """关闭 PyAudio 流。"""
@@ -70,7 +157,10 @@ class MicClient:
             self.stream.close()
             self.stream = None
         self.is_recording = False
-        print("PyAudio stream closed.")
+        # 唤醒可能在等待数据的发送协程
+        if self._loop is not None and self._data_evt is not None:
+            self._loop.call_soon_threadsafe(self._data_evt.set)
+        log.info("PyAudio stream closed.")
 
     async def stream_audio_to_server(self, ws_conn: websockets.WebSocketClientProtocol):
         """
@@ -79,59 +169,80 @@ class MicClient:
         :param ws_conn: 已建立的 WebSocket 连接对象。
         """
         if not self.is_recording or not self.stream:
-            print("Error: Audio stream not started. Calling start_stream().")
+            log.warning("Audio stream not started. Calling start_stream().")
             self.start_stream()
 
-        print("Starting microphone data transmission...")
+        log.info("Starting microphone data transmission...")
         
         voice_active = False # VAD 状态
+        n = self.chunk_samples
+        size = len(self._ring)
         
+        # 唤醒事件就绪后再启动 PyAudio 流
+        self._loop = asyncio.get_running_loop()
+        self._data_evt = asyncio.Event()
+        self._write_idx = self._read_idx = 0
+        pos = 0 # 下一个待处理的采样点
+        if not self.stream.is_active():
+            self.stream.start_stream()
+
         try:
             while self.is_recording:
-                # 1. 从麦克风读取 PCM 数据
-                # 使用 run_in_executor 将阻塞的 read 操作放到线程池中，避免阻塞 asyncio
-                loop = asyncio.get_running_loop()
-                # stream.read() 是阻塞操作
-                audio_chunk = await loop.run_in_executor(
-                    None, self.stream.read, AUDIO_CHUNK_SIZE, False
-                )
-                
-                if not audio_chunk:
-                    continue
-                
-                # 2. VAD 处理逻辑
-                if VAD_ENABLED and self.vad:
-                    is_speech = self.vad.process_chunk(audio_chunk)
-                    
-                    if not voice_active and is_speech:
-                        voice_active = True
-                        print("[VAD] Voice activity detected. Starting stream.")
-                        # 如果需要，可以在这里发送一个 'stream_start' 的控制帧
+                # 1. 等待回调线程写入新的 PCM 数据
+                await self._data_evt.wait()
+                self._data_evt.clear()
+
+                while pos + n <= self._write_idx:
+                    lo, pos = pos, pos + n
+                    off = lo % size
+                    send_chunk = True
+
+                    # 2. VAD 处理逻辑 (直接在环形缓冲区的视图上计算，不产生拷贝)
+                    if VAD_ENABLED and self.vad:
+                        is_speech = self.vad.process_chunk(self._ring[off:off + n].data.cast('B'))
                         
-                    elif voice_active and not is_speech:
-                        # 持续静音，判断是否结束
-                        if self.vad.is_silence_end():
-                            voice_active = False
-                            print("[VAD] End of speech detected. Pausing stream.")
-                            # 发送一个 'stream_end' 的控制帧，让服务端知道这段语音结束了
-                            # await ws_conn.send(json.dumps({"is_final": True}))
-                            # 忽略后续静音数据
-                            continue 
-                    
-                    if not voice_active:
-                        # VAD 禁用时，所有数据都发送
-                        continue
+                        if not voice_active and is_speech:
+                            voice_active = True
+                            log.debug("[VAD] Voice activity detected. Starting stream.")
+                            # 如果需要，可以在这里发送一个 'stream_start' 的控制帧
+                            
+                        elif voice_active and not is_speech:
+                            # 持续静音，判断是否结束
+                            if self.vad.is_silence_end():
+                                voice_active = False
+                                log.debug("[VAD] End of speech detected. Pausing stream.")
+                                # 发送一个 'stream_end' 的控制帧，让服务端知道这段语音结束了
+                                # await ws_conn.send(json.dumps({"is_final": True}))
                         
-                # 3. 发送音频数据 (直接发送二进制 PCM 数据)
-                await ws_conn.send(audio_chunk)
+                        # 未处于语音段时忽略该块
+                        send_chunk = voice_active
+
+                    if not send_chunk:
+                        # 语音段结束时立即发出尚未凑满的批次，并释放已处理的缓冲区
+                        await self._flush_batch(ws_conn, pos)
+                        continue
+                            
+                    # 3. 将该块计入批次，凑满一批后直接发送环形缓冲区上的视图 (仅首尾回绕时拷贝一次)
+                    if self._batch_lo is None:
+                        self._batch_lo = lo
+                    self._batch_n += 1
+                    if self._batch_n >= self.batch_frames:
+                        await self._flush_batch(ws_conn, pos)
+
+            # 正常退出时发出剩余的批次
+            await self._flush_batch(ws_conn, pos)
 
         except websockets.exceptions.ConnectionClosedOK:
-            print("WebSocket connection closed normally.")
+            log.info("WebSocket connection closed normally.")
         except Exception as e:
-            print(f"An error occurred during audio streaming: {e}")
+            log.error("An error occurred during audio streaming: %s", e)
         finally:
-            print("Microphone data transmission finished.")
+            log.info("Microphone data transmission finished.")
             self.stop_stream()
+            self._data_evt = None
+            self._loop = None
+            self._batch_lo = None
+            self._batch_n = 0
 
 
 if __name__ == '__main__':
@@ -147,7 +258,7 @@ if __name__ == '__main__':
 
         print(f"Connecting to {MOCK_SERVER_URL}...")
         try:
-            async with websockets.connect(MOCK_SERVER_URL) as ws:
+            async with websockets.connect(MOCK_SERVER_URL, **WS_CONNECT_OPTIONS) as ws:
                 print("WebSocket connected. Starting audio stream...")
                 await mic_client.stream_audio_to_server(ws)
                 
@@ -1,17 +1,25 @@
 import pyaudio
 import asyncio
+import collections
+import logging
+import threading
 import websockets
 import time
-from typing import Optional
+from typing import Optional, Deque
+
+log = logging.getLogger(__name__)
 
 # 导入小车端配置 (假设 config.py 已经定义)
 try:
-    from car.config import AUDIO_OUT_RATE, AUDIO_OUT_CHANNELS, AUDIO_FORMAT
+    from car.config import AUDIO_OUT_RATE, AUDIO_OUT_CHANNELS, AUDIO_FORMAT, WS_CONNECT_OPTIONS
+    from car.config import SPEAKER_MAX_BACKLOG_MS
 except ImportError:
-    print("Warning: car.config not found. Using default speaker settings.")
+    log.warning("car.config not found. Using default speaker settings.")
     AUDIO_OUT_RATE = 24000         # 服务端 TTS 输出的采样率 (CosyVoice 常用)
     AUDIO_OUT_CHANNELS = 1         # 单声道
     AUDIO_FORMAT = pyaudio.paInt16 # 16-bit PCM
+    WS_CONNECT_OPTIONS = {"compression": None, "max_size": None, "write_limit": 2 ** 18}
+    SPEAKER_MAX_BACKLOG_MS = 3000  # 播放队列积压上限 (毫秒)
 
 
 class SpeakerClient:
@@ -19,10 +27,22 @@ class SpeakerClient:
     扬声器客户端：负责从服务端接收 PCM 音频流，并实时写入本地播放设备。
     """
 
-    def __init__(self):
+    def __init__(self, max_backlog_ms: int = SPEAKER_MAX_BACKLOG_MS):
         self.p = pyaudio.PyAudio()
         self.stream: Optional[pyaudio.Stream] = None
         self.is_playing = False
+        # 播放队列：事件循环只负责入队，专用的守护线程循环执行阻塞的 stream.write，
+        # 不为每个音频块创建 Future，也不经过线程池
+        self._play_q: Deque[bytes] = collections.deque()
+        # 积压上限 (字节)：超出时丢弃最旧的数据，限制内存占用与播放延迟
+        bytes_per_ms = AUDIO_OUT_RATE * AUDIO_OUT_CHANNELS * pyaudio.get_sample_size(AUDIO_FORMAT) // 1000
+        self.max_backlog_bytes = max_backlog_ms * bytes_per_ms
+        self._play_q_bytes = 0
+        self.dropped_chunks = 0
+        self._play_cond = threading.Condition()
+        self._writing = False
+        self._writer_stop = False
+        self._writer_thread: Optional[threading.Thread] = None
         self.open_stream() # 在初始化时打开音频流
 
     def open_stream(self):
@@ -41,7 +61,7 @@ class SpeakerClient:
             frames_per_buffer=1024 
         )
         self.is_playing = True
-        print(f"PyAudio speaker stream opened. Rate: {AUDIO_OUT_RATE}Hz")
+        log.info("PyAudio speaker stream opened. Rate: %sHz", AUDIO_OUT_RATE)
 
 
     def close_stream(self):
@@ -51,13 +71,79 @@ class SpeakerClient:
             self.stream.close()
             self.stream = None
         self.is_playing = False
-        print("PyAudio speaker stream closed.")
+        log.info("PyAudio speaker stream closed.")
         
     def terminate(self):
         """终止 PyAudio 实例。"""
+        self._stop_writer()
         self.close_stream()
         self.p.terminate()
-        print("PyAudio instance terminated.")
+        log.info("PyAudio instance terminated.")
+
+    def enqueue_chunk(self, audio_chunk: bytes):
+        """将一块 PCM 数据放入播放队列并唤醒写入线程，不阻塞事件循环。"""
+        if self._writer_thread is None or not self._writer_thread.is_alive():
+            self._writer_stop = False
+            self._writer_thread = threading.Thread(
+                target=self._writer_loop, name="speaker-writer", daemon=True
+            )
+            self._writer_thread.start()
+        with self._play_cond:
+            self._play_q.append(audio_chunk)
+            self._play_q_bytes += len(audio_chunk)
+            # 积压超过上限时丢弃最旧的块 (至少保留刚入队的块)
+            while self._play_q_bytes > self.max_backlog_bytes and len(self._play_q) > 1:
+                self._play_q_bytes -= len(self._play_q.popleft())
+                self.dropped_chunks += 1
+            self._play_cond.notify()
+
+    def _writer_loop(self):
+        """写入线程：等待播放队列中的数据，依次调用阻塞的 stream.write。"""
+        cond = self._play_cond
+        while True:
+            with cond:
+                while not self._play_q and not self._writer_stop:
+                    cond.wait()
+                if self._writer_stop:
+                    break
+                chunk = self._play_q.popleft()
+                self._play_q_bytes -= len(chunk)
+                self._writing = True
+            try:
+                stream = self.stream
+                if stream:
+                    stream.write(chunk)
+            except Exception as e:
+                log.error("Error writing audio to speaker: %s", e)
+            finally:
+                with cond:
+                    self._writing = False
+                    cond.notify_all()
+
+    def _wait_idle(self):
+        """阻塞直到播放队列为空且当前块写入完成 (写入线程已退出时立即返回)。"""
+        with self._play_cond:
+            self._play_cond.wait_for(
+                lambda: not (self._play_q or self._writing)
+                or self._writer_stop
+                or not (self._writer_thread and self._writer_thread.is_alive())
+            )
+
+    def _stop_writer(self):
+        """停止写入线程并丢弃尚未播放的数据。"""
+        with self._play_cond:
+            self._writer_stop = True
+            self._play_q.clear()
+            self._play_q_bytes = 0
+            self._play_cond.notify_all()
+        if self._writer_thread:
+            self._writer_thread.join(timeout=1.0)
+            self._writer_thread = None
+
+    async def drain(self):
+        """等待播放队列中已排队的音频播放完毕。"""
+        if self._writer_thread and self._writer_thread.is_alive():
+            await asyncio.to_thread(self._wait_idle)
 
 
     async def receive_and_play_audio(self, ws_conn: websockets.WebSocketClientProtocol):
@@ -67,34 +153,30 @@ class SpeakerClient:
         :param ws_conn: 已建立的 WebSocket 连接对象。
         """
         if not self.is_playing or not self.stream:
-            print("Error: Speaker stream not open. Attempting to reopen.")
+            log.warning("Speaker stream not open. Attempting to reopen.")
             self.open_stream()
             
-        print("Starting audio playback receiver...")
+        log.info("Starting audio playback receiver...")
         
         try:
             # 持续监听 WebSocket 消息
             async for message in ws_conn:
                 if isinstance(message, bytes):
-                    # 收到 PCM 数据块，立即写入播放流
-                    audio_chunk = message
-                    
-                    # 异步地执行阻塞的 write 操作
-                    loop = asyncio.get_running_loop()
-                    await loop.run_in_executor(
-                        None, self.stream.write, audio_chunk
-                    )
+                    # 收到 PCM 数据块，放入播放队列等待播放
+                    self.enqueue_chunk(message)
                     
                 # 可以根据需要处理 JSON 消息（例如 AudioFrame 的 is_final 标记）
                 # elif isinstance(message, str):
                 #     pass 
 
         except websockets.exceptions.ConnectionClosed:
-            print("WebSocket connection closed, stopping playback.")
+            log.info("WebSocket connection closed, stopping playback.")
         except Exception as e:
-            print(f"An error occurred during audio playback: {e}")
+            log.error("An error occurred during audio playback: %s", e)
         finally:
-            print("Audio playback receiver finished.")
+            log.info("Audio playback receiver finished.")
+            # 播放完已缓冲的音频后再停止
+            await self.drain()
             # 注意：不关闭 stream，等待下一次播放，但可以停止播放流
             self.stream.stop_stream()
             
@@ -112,7 +194,7 @@ if __name__ == '__main__':
         
         try:
             # 假设连接的是一个能推流的 WebSocket 路径
-            async with websockets.connect(MOCK_SERVER_URL) as ws:
+            async with websockets.connect(MOCK_SERVER_URL, **WS_CONNECT_OPTIONS) as ws:
                 print("WebSocket connected. Waiting for audio stream...")
                 # 模拟长时间运行
                 await speaker_client.receive_and_play_audio(ws)
@@ -1,14 +1,17 @@
-import collections
+import logging
+import math
 import numpy as np
 import time
-from typing import Optional, List, Deque
+from typing import Optional, List, Iterator
+
+log = logging.getLogger(__name__)
 
 # 假设使用 WebRTC VAD 的 Python 封装
 try:
     # pip install webrtcvad
     import webrtcvad 
 except ImportError:
-    print("Warning: webrtcvad library not found. VADDetector will use mock implementation.")
+    log.warning("webrtcvad library not found. VADDetector will use mock implementation.")
     class MockWebRTCVAD:
         def __init__(self, mode):
             self.mode = mode
@@ -27,6 +30,16 @@ VAD_MODE = 3 # 0: 最不激进, 3: 最激进/准确
 SILENCE_TIMEOUT_MS = 1500 # 语音结束后，等待 1.5 秒静音后判断传输结束
 SILENCE_CHUNK_COUNT = 50 # 粗略估计：16k/20ms -> 50 chunks/sec, 1.5s -> 75 chunks (这里取保守值)
 
+# NumPy 能量 + 过零率 VAD 配置
+NUMPY_VAD_MIN_RMS = 300.0          # RMS 阈值下限 (int16 幅度)
+NUMPY_VAD_NOISE_FACTOR = 3.0       # RMS 阈值 = 底噪 RMS * 该系数
+NUMPY_VAD_ZCR_MIN_RATE = 0.02      # 每个采样点的最小过零率，低于该值视为直流/低频噪声
+NUMPY_VAD_CALIBRATION_FRAMES = 20  # 用前 N 个静音帧估计底噪
+NUMPY_VAD_ZERO_PREFILTER_RATE = 0.05  # 非零采样点占比低于该值的帧直接判为静音
+
+# 语音开始前缓存的静音帧数 (leading silence)
+LEADING_BUFFER_FRAMES = SILENCE_CHUNK_COUNT // 2
+
 
 class VADDetector:
     """
@@ -34,13 +47,15 @@ class VADDetector:
     用于在客户端过滤静音，只上传包含语音的部分。
     """
 
-    def __init__(self, sample_rate: int, chunk_duration_ms: int = 20, aggressiveness: int = VAD_MODE):
+    def __init__(self, sample_rate: int, chunk_duration_ms: int = 20, aggressiveness: int = VAD_MODE,
+                 use_numpy_vad: bool = True):
         """
         初始化 VAD 检测器。
         
         :param sample_rate: 音频采样率 (必须是 WebRTC VAD 支持的值)。
         :param chunk_duration_ms: 每个音频块的持续时间 (WebRTC VAD 建议 10, 20, 30 ms)。
         :param aggressiveness: VAD 积极性模式 (0-3)。
+        :param use_numpy_vad: 使用 NumPy 向量化的能量 + 过零率检测代替 WebRTC VAD。
         """
         if sample_rate not in SUPPORTED_VAD_RATES:
             raise ValueError(f"Sample rate {sample_rate} not supported by WebRTC VAD. Must be one of {SUPPORTED_VAD_RATES}")
@@ -56,15 +71,67 @@ class VADDetector:
             self._vad = MockWebRTCVAD(aggressiveness)
             self.is_mock = True
 
+        # NumPy VAD：阈值在前若干个静音帧中根据底噪自动校准
+        self._use_numpy_vad = use_numpy_vad
+        self.rms_thr = NUMPY_VAD_MIN_RMS
+        self.zcr_thr_lo = int((self.chunk_size // 2) * NUMPY_VAD_ZCR_MIN_RATE)
+        self._noise_rms = 0.0
+        self._calib_frames = 0
+
+        # 预分配的计算缓冲区，每帧复用，避免 NumPy 临时数组分配
+        frames = self.chunk_size // 2
+        self._scratch_i32 = np.empty(frames, dtype=np.int32)
+        self._scratch_sq = np.empty(frames, dtype=np.int32)
+        self._scratch_sign = np.empty(frames, dtype=np.bool_)
+        self._scratch_diff = np.empty(frames - 1, dtype=np.bool_)
+
         # 用于判断语音结束的静音帧计数器
         self.silence_chunks_count = 0
         self.active_speech_detected = False
 
-        # 缓冲队列：用于存储语音开始前的少量静音帧 (leading silence)
-        self.frame_buffer: Deque[bytes] = collections.deque(maxlen=SILENCE_CHUNK_COUNT // 2) 
+        # 滑动窗口：用于存储语音开始前的少量静音帧 (leading silence)
+        # 预分配一整块连续的 int16 数组，按采样点循环写入，便于对整个窗口做向量化分析
+        self._frame_samples = frames
+        self._ring_frames = LEADING_BUFFER_FRAMES
+        self._window = np.zeros(frames * self._ring_frames, dtype=np.int16)
+        self._w_head = 0  # 下一个写入位置 (采样点下标)
+        self._count = 0   # 当前缓存的帧数
+
+        log.info("VADDetector initialized. Rate: %sHz, Chunk: %sms, Mode: %s", sample_rate, chunk_duration_ms, aggressiveness)
+
+    def _numpy_is_speech(self, audio_chunk: bytes) -> bool:
+        """
+        基于 RMS 能量和过零率的向量化语音判断，整帧计算都在 NumPy 的 C 循环中完成。
+        """
+        view = np.frombuffer(audio_chunk, dtype=np.int16)
+        s = self._scratch_i32
+        np.copyto(s, view, casting='unsafe')
+
+        # int16 的平方不会溢出 int32，求和时再提升到 int64
+        energy = int(np.square(s, out=self._scratch_sq).sum(dtype=np.int64))
+        rms = math.sqrt(energy / len(s))
 
-        print(f"VADDetector initialized. Rate: {sample_rate}Hz, Chunk: {chunk_duration_ms}ms, Mode: {aggressiveness}")
+        sign = np.signbit(s, out=self._scratch_sign)
+        zcr = int(np.count_nonzero(np.not_equal(sign[1:], sign[:-1], out=self._scratch_diff)))
+        is_speech = rms > self.rms_thr and zcr > self.zcr_thr_lo
 
+        # 用最初的静音帧估计底噪 (RMS 滑动平均)，并据此抬高阈值
+        if not is_speech and self._calib_frames < NUMPY_VAD_CALIBRATION_FRAMES:
+            self._calib_frames += 1
+            self._noise_rms += (rms - self._noise_rms) / self._calib_frames
+            self.rms_thr = max(NUMPY_VAD_MIN_RMS, self._noise_rms * NUMPY_VAD_NOISE_FACTOR)
+
+        return is_speech
+
+    def _buffer_frame(self, audio_chunk: bytes):
+        """将一帧写入滑动窗口，写满后覆盖最旧的帧。"""
+        view = np.frombuffer(audio_chunk, dtype=np.int16)
+        head = self._w_head
+        # 窗口长度是帧长的整数倍，单帧写入不会跨越窗口末尾
+        self._window[head:head + len(view)] = view
+        self._w_head = (head + len(view)) % len(self._window)
+        if self._count < self._ring_frames:
+            self._count += 1
 
     def process_chunk(self, audio_chunk: bytes) -> bool:
         """
@@ -74,13 +141,24 @@ class VADDetector:
         :return: True 如果检测到语音，False 否则。
         """
         if len(audio_chunk) != self.chunk_size:
-            print(f"Warning: Audio chunk size mismatch. Expected {self.chunk_size}, Got {len(audio_chunk)}")
+            log.debug("Audio chunk size mismatch. Expected %s, Got %s", self.chunk_size, len(audio_chunk))
             # 尝试截断或填充，但 WebRTC VAD 对大小要求严格
             # 这里简单返回 False
             return False 
 
+        # 0. 快速预过滤：几乎全为零采样的帧直接视为静音，跳过 VAD 计算
+        samples = np.frombuffer(audio_chunk, dtype=np.int16)
+        if np.count_nonzero(samples) < len(samples) * NUMPY_VAD_ZERO_PREFILTER_RATE:
+            if self.active_speech_detected:
+                self.silence_chunks_count += 1
+            self._buffer_frame(audio_chunk)
+            return False
+
         # 1. 检测当前帧是否是语音
-        is_speech = self._vad.is_speech(audio_chunk, self.sample_rate)
+        if self._use_numpy_vad:
+            is_speech = self._numpy_is_speech(audio_chunk)
+        else:
+            is_speech = self._vad.is_speech(audio_chunk, self.sample_rate)
 
         if is_speech:
             self.active_speech_detected = True
@@ -94,7 +172,7 @@ class VADDetector:
                 
             # 尚未检测到语音时，缓存帧
             # 否则，如果是语音后的静音，我们将其作为 trailing silence 缓存
-            self.frame_buffer.append(audio_chunk)
+            self._buffer_frame(audio_chunk)
 
         return is_speech
 
@@ -109,24 +187,36 @@ class VADDetector:
             # 重置状态，准备下一次检测
             self.active_speech_detected = False
             self.silence_chunks_count = 0
-            self.frame_buffer.clear()
+            self._count = 0
             return True
         return False
 
-    def get_buffered_frames(self) -> List[bytes]:
+    def get_buffered_frames(self) -> Iterator[memoryview]:
         """
-        返回当前缓冲区中的帧 (用于在语音开始时发送 leading silence)。
+        按时间顺序返回当前缓冲区中的帧 (用于在语音开始时发送 leading silence)。
+        返回一个惰性迭代器，逐个产出滑动窗口的 memoryview (字节) 切片，不构建中间列表；
+        调用方应在处理下一帧之前迭代完毕。
         """
-        frames = list(self.frame_buffer)
-        self.frame_buffer.clear()
-        return frames
+        n = self._frame_samples
+        count = self._count
+        start = (self._w_head - count * n) % len(self._window)
+        self._count = 0
+        return self._iter_window(start, count)
+
+    def _iter_window(self, start: int, count: int) -> Iterator[memoryview]:
+        """从采样点 start 开始，依次产出 count 帧窗口切片。"""
+        n = self._frame_samples
+        size = len(self._window)
+        for i in range(count):
+            off = (start + i * n) % size
+            yield self._window[off:off + n].data.cast('B')
 
     def reset(self):
         """重置 VAD 状态。"""
         self.silence_chunks_count = 0
         self.active_speech_detected = False
-        self.frame_buffer.clear()
-        print("VAD state reset.")
+        self._count = 0
+        log.debug("VAD state reset.")
 
 
 if __name__ == '__main__':
@@ -140,7 +230,8 @@ if __name__ == '__main__':
     # 模拟帧大小 (16kHz, 16bit, 20ms) -> 16000 * 0.020 * 2 = 640 bytes
     SPEECH_CHUNK_SIZE = 640
     SILENCE_CHUNK = b'\x00' * SPEECH_CHUNK_SIZE # 纯静音
-    NOISE_CHUNK = b'\x55' * SPEECH_CHUNK_SIZE # 噪音/语音
+    # 噪音/语音：正负交替的方波 (有能量且有过零)
+    NOISE_CHUNK = np.tile(np.array([8000, -8000], dtype=np.int16), SPEECH_CHUNK_SIZE // 4).tobytes()
     
     print("\n--- VAD Simulation Start ---")
     
@@ -1,20 +1,62 @@
 import asyncio
+import logging
+import socket
 import websockets
 import json
+from urllib.parse import urlsplit
 from typing import Optional, Callable, Dict, Any, Awaitable
 
+log = logging.getLogger(__name__)
+
 # 导入配置和协议
 try:
-    from car.config import SERVER_URL, AUDIO_IN_PATH, AUDIO_OUT_PATH, CONTROL_PATH
+    from car.config import SERVER_URL, AUDIO_IN_PATH, AUDIO_OUT_PATH, CONTROL_PATH, WS_CONNECT_OPTIONS
+    from car.config import WS_CONNECT_RETRIES, WS_RETRY_BACKOFF_S, WS_RETRY_BACKOFF_MAX_S
+    from car.config import WS_SOCKET_NODELAY, WS_SOCKET_SNDBUF
     from server.api.protocol import ControlCmd, StatusMsg, parse_frame
 except ImportError:
-    print("Warning: Failed to import config or protocol. Using mock values.")
+    log.warning("Failed to import config or protocol. Using mock values.")
     SERVER_URL = "ws://127.0.0.1:8765"
     AUDIO_IN_PATH = "/audio/in"
     CONTROL_PATH = "/control"
+    WS_CONNECT_OPTIONS = {"compression": None, "max_size": None, "write_limit": 2 ** 18, "ping_interval": 20}
+    WS_CONNECT_RETRIES = 5
+    WS_RETRY_BACKOFF_S = 0.5
+    WS_RETRY_BACKOFF_MAX_S = 8.0
+    WS_SOCKET_NODELAY = True
+    WS_SOCKET_SNDBUF = 64 * 1024
     class ControlCmd:
         def __init__(self, type, value): self.type = type; self.value = value
         def to_json(self): return json.dumps(self.__dict__)
+    class StatusMsg:
+        def __init__(self, code, message): self.code = code; self.message = message
+    def parse_frame(data):
+        d = json.loads(data)
+        return ControlCmd(d['type'], d['value']) if 'type' in d and 'value' in d else None
+
+
+async def _open_tcp_socket(url: str) -> socket.socket:
+    """
+    为 WebSocket 连接预先建立 TCP 套接字，设置 TCP_NODELAY 与 SO_SNDBUF 后
+    再通过 websockets.connect(sock=...) 完成握手。
+    """
+    loop = asyncio.get_running_loop()
+    parts = urlsplit(url)
+    port = parts.port or (443 if parts.scheme == 'wss' else 80)
+    infos = await loop.getaddrinfo(parts.hostname, port, type=socket.SOCK_STREAM)
+    family, type_, proto, _, addr = infos[0]
+    sock = socket.socket(family, type_, proto)
+    try:
+        sock.setblocking(False)
+        if WS_SOCKET_NODELAY:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if WS_SOCKET_SNDBUF:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, WS_SOCKET_SNDBUF)
+        await loop.sock_connect(sock, addr)
+    except BaseException:
+        sock.close()
+        raise
+    return sock
 
 
 # 定义一个异步回调函数类型，用于处理接收到的控制命令
@@ -32,32 +74,48 @@ class WebSocketClient:
         self.conn: Optional[websockets.WebSocketClientProtocol] = None
         self._control_handler = control_handler
         self.is_connected = False
-        print(f"WebSocket Client initialized for: {self.url}")
+        # 连接断开事件：等待方无需轮询 is_connected。
+        # 在 connect() 中 (事件循环运行后) 创建，避免绑定到 asyncio.run 之前的事件循环
+        self.disconnected: Optional[asyncio.Event] = None
+        log.info("WebSocket Client initialized for: %s", self.url)
         
-    async def connect(self):
-        """尝试连接到服务端。"""
-        print(f"Attempting to connect to {self.url}...")
-        try:
-            self.conn = await websockets.connect(self.url)
-            self.is_connected = True
-            print(f"Successfully connected to {self.path}.")
-            return self.conn
-        except ConnectionRefusedError:
-            print(f"Connection refused by server at {self.url}.")
-            self.conn = None
-            return None
-        except Exception as e:
-            print(f"Connection error to {self.url}: {e}")
+    async def connect(self, retries: int = WS_CONNECT_RETRIES):
+        """尝试连接到服务端，失败时按指数退避重试，最多 retries 次。"""
+        if self.disconnected is None:
+            self.disconnected = asyncio.Event()
+        delay = WS_RETRY_BACKOFF_S
+        for attempt in range(1, retries + 1):
+            log.info("Attempting to connect to %s (%s/%s)...", self.url, attempt, retries)
+            try:
+                sock = await _open_tcp_socket(self.url)
+                self.conn = await websockets.connect(self.url, sock=sock, **WS_CONNECT_OPTIONS)
+                self.is_connected = True
+                self.disconnected.clear()
+                log.info("Successfully connected to %s.", self.path)
+                return self.conn
+            except ConnectionRefusedError:
+                log.warning("Connection refused by server at %s.", self.url)
+            except Exception as e:
+                log.warning("Connection error to %s: %s", self.url, e)
             self.conn = None
-            return None
+            if attempt < retries:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, WS_RETRY_BACKOFF_MAX_S)
+        return None
 
     async def disconnect(self):
         """断开连接。"""
         if self.conn:
             await self.conn.close()
             self.conn = None
-            self.is_connected = False
-            print(f"Disconnected from {self.url}.")
+            self.mark_disconnected()
+            log.info("Disconnected from %s.", self.url)
+
+    def mark_disconnected(self):
+        """标记连接已断开，并唤醒所有等待 disconnected 事件的协程。"""
+        self.is_connected = False
+        if self.disconnected is not None:
+            self.disconnected.set()
 
     def get_connection(self) -> Optional[websockets.WebSocketClientProtocol]:
         """获取当前连接对象，供 MicClient/SpeakerClient 使用。"""
@@ -69,10 +127,10 @@ class WebSocketClient:
             try:
                 await self.conn.send(chunk)
             except websockets.exceptions.ConnectionClosed:
-                print("Cannot send audio: Connection closed.")
-                self.is_connected = False
+                log.warning("Cannot send audio: Connection closed.")
+                self.mark_disconnected()
             except Exception as e:
-                print(f"Error sending audio chunk: {e}")
+                log.error("Error sending audio chunk: %s", e)
 
     async def send_json(self, data: Dict[str, Any]):
         """发送 JSON 控制信息（可选，例如心跳或结束标记）。"""
@@ -80,10 +138,25 @@ class WebSocketClient:
             try:
                 await self.conn.send(json.dumps(data))
             except websockets.exceptions.ConnectionClosed:
-                print("Cannot send JSON: Connection closed.")
-                self.is_connected = False
+                log.warning("Cannot send JSON: Connection closed.")
+                self.mark_disconnected()
             except Exception as e:
-                print(f"Error sending JSON: {e}")
+                log.error("Error sending JSON: %s", e)
+
+    async def dispatch_text(self, message: str):
+        """
+        解析一条文本消息并分发：动作指令交给 control_handler，状态消息写入日志。
+        所有接收循环都通过此方法处理文本帧，保证每条消息只解析一次。
+        """
+        frame = parse_frame(message)
+
+        if isinstance(frame, ControlCmd) and self._control_handler:
+            # 发现动作指令，调用回调函数
+            await self._control_handler(frame)
+        elif isinstance(frame, StatusMsg):
+            log.info("[Status] Code %s: %s", frame.code, frame.message)
+        else:
+            log.debug("[Unknown Frame] Received text: %s...", message[:50])
 
     async def listen_for_control_commands(self):
         """
@@ -91,36 +164,27 @@ class WebSocketClient:
         此方法通常在一个独立的 asyncio Task 中运行，尤其是在处理 /audio/in 的双向流时。
         """
         if not self.conn:
-            print(f"Cannot listen: Not connected to {self.path}.")
+            log.warning("Cannot listen: Not connected to %s.", self.path)
             return
 
-        print(f"Starting listener for control/status messages on {self.path}...")
+        log.info("Starting listener for control/status messages on %s...", self.path)
         try:
             async for message in self.conn:
-                if isinstance(message, str):
-                    # 尝试解析为协议帧
-                    frame = parse_frame(message)
-                    
-                    if isinstance(frame, ControlCmd) and self._control_handler:
-                        # 发现动作指令，调用回调函数
-                        await self._control_handler(frame)
-                    elif isinstance(frame, StatusMsg):
-                        print(f"[Status] Code {frame.code}: {frame.message}")
-                    else:
-                        print(f"[Unknown Frame] Received text: {message[:50]}...")
-                        
-                elif isinstance(message, bytes):
+                # 二进制消息 (TTS 音频) 占绝大多数，先判断以便尽快跳过
+                if isinstance(message, bytes):
                     # 收到二进制数据，通常是 TTS 音频，不在此处处理
                     # 应该由 SpeakerClient 的 receive_and_play_audio 方法处理
-                    pass
+                    continue
+
+                await self.dispatch_text(message)
 
         except websockets.exceptions.ConnectionClosed:
-            print(f"Listener detected connection closed on {self.path}.")
-            self.is_connected = False
+            log.info("Listener detected connection closed on %s.", self.path)
+            self.mark_disconnected()
         except Exception as e:
-            print(f"Error in listener on {self.path}: {e}")
+            log.error("Error in listener on %s: %s", self.path, e)
         finally:
-            print(f"Listener on {self.path} stopped.")
+            log.info("Listener on %s stopped.", self.path)
 
 
 class CommManager:
@@ -138,10 +202,15 @@ class CommManager:
         self.control_handler = control_handler
         self.listener_task: Optional[asyncio.Task] = None
         
-    async def establish_connection(self) -> Optional[websockets.WebSocketClientProtocol]:
-        """建立连接并启动监听任务。"""
+    async def establish_connection(self, start_listener: bool = True) -> Optional[websockets.WebSocketClientProtocol]:
+        """
+        建立连接并启动监听任务。
+        
+        :param start_listener: 是否启动内置的控制指令监听任务。调用方自行接收连接上的消息时
+                               应传入 False，避免同一连接被两个接收循环读取、同一帧被重复解析。
+        """
         conn = await self.audio_control_client.connect()
-        if conn:
+        if conn and start_listener:
             # 启动一个独立的 Task 来监听控制指令和状态消息
             self.listener_task = asyncio.create_task(
                 self.audio_control_client.listen_for_control_commands()
@@ -11,16 +11,39 @@ AUDIO_IN_PATH = "/audio/in"   # 麦克风音频流上传路径
 AUDIO_OUT_PATH = "/audio/in"  # TTS 语音流接收路径 (假设使用同一连接的双向流)
 CONTROL_PATH = "/control"     # 动作指令和心跳路径 (假设也用同一连接)
 
+# websockets.connect 参数：PCM 音频无法被 deflate 有效压缩，关闭压缩以节省 CPU；
+# 不限制单帧大小 (合并发送的音频帧)；提高写缓冲上限，避免频繁的背压暂停
+WS_CONNECT_OPTIONS = {
+    "compression": None,
+    "max_size": None,
+    "write_limit": 2 ** 18,
+    "ping_interval": 20,  # 心跳保活，尽早发现断开的连接
+}
+
+# TCP 套接字选项：关闭 Nagle 算法降低小帧 (控制指令/音频块) 延迟，发送缓冲区约为一个音频批次
+WS_SOCKET_NODELAY = True
+WS_SOCKET_SNDBUF = 64 * 1024
+
+# 连接失败时的重试策略 (指数退避)
+WS_CONNECT_RETRIES = 5         # 最多尝试次数
+WS_RETRY_BACKOFF_S = 0.5       # 首次重试等待时间 (秒)，之后每次翻倍
+WS_RETRY_BACKOFF_MAX_S = 8.0   # 单次等待上限 (秒)
+
 # --- 音频设备配置 (与服务端模型匹配) ---
 # 麦克风输入 (ASR 输入)
 AUDIO_RATE = 16000         # 采样率 (Hz)
 AUDIO_CHANNELS = 1         # 声道数 (单声道)
 AUDIO_FORMAT = 8           # PyAudio.paInt16 对应的数字
 AUDIO_CHUNK_SIZE = 1024    # 每次从麦克风读取的帧大小 (bytes)
+AUDIO_SEND_BATCH_FRAMES = 3 # 合并多少个音频块后再发送一个 WebSocket 帧
+MIC_BUFFER_CHUNKS = 4      # PortAudio 内部缓冲区大小 (以音频块为单位)，用于吸收调度抖动
 
 # 扬声器输出 (TTS 输出)
 AUDIO_OUT_RATE = 24000         # 服务端 CosyVoice 模型的输出采样率
 AUDIO_OUT_CHANNELS = 1
+# 播放队列积压上限 (毫秒)，超出时丢弃最旧的音频。服务端 TTS 以快于实时的速度推送，
+# 该值需容纳一次回复的突发输出，过小会截断语音
+SPEAKER_MAX_BACKLOG_MS = 3000
 
 # --- VAD 配置 ---
 VAD_ENABLED = True             # 是否启用本地语音活动检测 (建议启用)
@@ -56,7 +79,10 @@ CONFIG = {
     "AUDIO_DEVICE": {
         "RATE_IN": AUDIO_RATE,
         "RATE_OUT": AUDIO_OUT_RATE,
+        "SPEAKER_MAX_BACKLOG_MS": SPEAKER_MAX_BACKLOG_MS,
         "CHUNK_SIZE": AUDIO_CHUNK_SIZE,
+        "SEND_BATCH_FRAMES": AUDIO_SEND_BATCH_FRAMES,
+        "MIC_BUFFER_CHUNKS": MIC_BUFFER_CHUNKS,
         "VAD_ENABLED": VAD_ENABLED,
     },
     "HARDWARE": {
@@ -1,7 +1,13 @@
 import asyncio
+import logging
+import re
+import signal
 import sys
 import os
 import time
+from typing import Optional
+
+log = logging.getLogger(__name__)
 
 # 将项目根目录添加到 Python 路径，以便导入模块
 # 假设 main.py 位于 petcar-ai/car/
@@ -10,6 +16,7 @@ sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 # 导入所有客户端组件和配置
 try:
     from car.config import CONFIG, SERVER_URL, AUDIO_IN_PATH, MOTOR_PINS, STATUS_LED_PIN
+    import websockets
     from car.comm.client import CommManager, ControlCmd
     from car.audio.mic_client import MicClient
     from car.audio.speaker_client import SpeakerClient
@@ -18,7 +25,7 @@ try:
     try:
         import RPi.GPIO as GPIO
     except ImportError:
-        print("Warning: RPi.GPIO not found. Using mock hardware control.")
+        log.warning("RPi.GPIO not found. Using mock hardware control.")
         class MockGPIO:
             BCM = 0; OUT = 0; LOW = 0; HIGH = 1; PWM = lambda: None
             def setmode(*args): pass
@@ -34,10 +41,34 @@ try:
         GPIO = MockGPIO()
         
 except ImportError as e:
-    print(f"FATAL ERROR: Failed to import necessary modules: {e}")
+    log.critical("FATAL ERROR: Failed to import necessary modules: %s", e)
     sys.exit(1)
 
 
+# 电机方向引脚顺序：左前、左后、右前、右后
+DRIVE_PINS = (
+    MOTOR_PINS["LEFT_FORWARD"],
+    MOTOR_PINS["LEFT_BACKWARD"],
+    MOTOR_PINS["RIGHT_FORWARD"],
+    MOTOR_PINS["RIGHT_BACKWARD"],
+)
+
+# 预先计算的运动方向 -> 引脚电平表，一次 GPIO.output 调用即可设置全部引脚
+DRIVE_LEVELS = {
+    'forward':  (1, 0, 1, 0),
+    'backward': (0, 1, 0, 1),
+    'left':     (0, 1, 1, 0),  # 左轮后退，右轮前进
+    'right':    (1, 0, 0, 1),  # 左轮前进，右轮后退
+    'stop':     (0, 0, 0, 0),
+}
+
+# 关闭时等待后台任务退出的最长时间 (秒)
+SHUTDOWN_TIMEOUT_S = 3.0
+
+# 动作指令格式：name 或 name(int)，例如 forward(5)、turn_left(90)、stop
+_ACTION_RE = re.compile(r'(\w+)(?:\(\s*(-?\d+)?\s*\))?')
+
+
 class CarController:
     """
     PetCar 小车端的主控制器。
@@ -49,11 +80,25 @@ class CarController:
         self.speaker_client = SpeakerClient()
         self.comm_manager = CommManager(control_handler=self.execute_action_command)
         self.hardware_initialized = False
+        # 最近一次写入方向引脚的电平，未变化时跳过 GPIO 写入
+        self._drive_levels: Optional[tuple] = None
         
         self.mic_stream_task: Optional[asyncio.Task] = None
         self.speaker_stream_task: Optional[asyncio.Task] = None
+        # 停止事件：收到 SIGINT/SIGTERM 时被设置
+        self._stop_event: Optional[asyncio.Event] = None
+        self._shutdown_done = False
+        # 自动停车定时器：每条新指令重置，避免为每条指令各自创建延时任务
+        self._stop_timer: Optional[asyncio.TimerHandle] = None
+        # 动作名 -> (处理函数, 方向, 默认参数)
+        self._actions = {
+            'forward': (self._move_car, 'forward', 1),
+            'backward': (self._move_car, 'backward', 1),
+            'turn_left': (self._turn_car, 'left', 90),
+            'turn_right': (self._turn_car, 'right', 90),
+        }
         
-        print("\n--- PetCar AI Client Initialized ---")
+        log.info("--- PetCar AI Client Initialized ---")
         
     def _init_hardware(self):
         """初始化树莓派 GPIO 和电机引脚。"""
@@ -71,16 +116,18 @@ class CarController:
                 GPIO.output(STATUS_LED_PIN, GPIO.LOW)
                 
             self.hardware_initialized = True
-            print("Hardware (GPIO) initialized successfully.")
+            self._drive_levels = DRIVE_LEVELS['stop']
+            log.info("Hardware (GPIO) initialized successfully.")
         except Exception as e:
-            print(f"Hardware initialization failed: {e}. Running in non-motor control mode.")
+            log.warning("Hardware initialization failed: %s. Running in non-motor control mode.", e)
             GPIO.cleanup() # 确保在失败时清理
 
     def _cleanup_hardware(self):
         """清理 GPIO 设置。"""
         if self.hardware_initialized:
             GPIO.cleanup()
-            print("Hardware (GPIO) cleaned up.")
+            self._drive_levels = None
+            log.info("Hardware (GPIO) cleaned up.")
 
     async def execute_action_command(self, cmd: ControlCmd):
         """
@@ -89,104 +136,108 @@ class CarController:
         :param cmd: 包含动作类型和参数的 ControlCmd 对象。
         """
         if cmd.type != 'action':
-            print(f"[ACTION] Ignoring non-action command: {cmd.type}")
+            log.debug("[ACTION] Ignoring non-action command: %s", cmd.type)
             return
             
         action_str = cmd.value.strip()
-        print(f"[ACTION] Received command: {action_str}")
+        log.info("[ACTION] Received command: %s", action_str)
 
-        # 1. 解析动作指令 (例如: forward(5), turn_left(90))
+        # 1. 解析动作指令 (例如: forward(5), turn_left(90), stop)
         try:
-            # 简单解析：获取动作名和参数
-            action_name = action_str.split('(')[0]
-            params = action_str.split('(')[1].rstrip(')').split(',')
-            
-            # 2. 执行硬件操作
-            if action_name == 'forward':
-                steps = int(params[0]) if params and params[0] else 1
-                self._move_car(direction='forward', duration_steps=steps)
-            elif action_name == 'backward':
-                steps = int(params[0]) if params and params[0] else 1
-                self._move_car(direction='backward', duration_steps=steps)
-            elif action_name == 'turn_left':
-                degrees = int(params[0]) if params and params[0] else 90
-                self._turn_car(direction='left', duration_degrees=degrees)
-            elif action_name == 'turn_right':
-                degrees = int(params[0]) if params and params[0] else 90
-                self._turn_car(direction='right', duration_degrees=degrees)
-            elif action_name == 'stop':
+            m = _ACTION_RE.fullmatch(action_str)
+            if not m:
+                log.warning("[ACTION] Malformed action: %s", action_str)
                 self._stop_car()
-            else:
-                print(f"[ACTION] Unknown action: {action_name}")
+                return
+            action_name, arg = m.group(1), m.group(2)
+
+            # 2. 查表执行硬件操作
+            if action_name == 'stop':
+                self._stop_car()
+                return
+            action = self._actions.get(action_name)
+            if action is None:
+                log.warning("[ACTION] Unknown action: %s", action_name)
+                return
+            handler, direction, default = action
+            handler(direction, int(arg) if arg else default)
 
         except Exception as e:
-            print(f"[ACTION] Error executing action '{action_str}': {e}")
+            log.error("[ACTION] Error executing action '%s': %s", action_str, e)
             self._stop_car()
 
 
     def _move_car(self, direction: str, duration_steps: int):
         """模拟/执行小车前进或后退的硬件控制。"""
         if not self.hardware_initialized:
-            print(f"Mocking move car: {direction} for {duration_steps} steps.")
+            log.debug("Mocking move car: %s for %s steps.", direction, duration_steps)
             return
 
-        print(f"Moving car: {direction}...")
-        
-        # 简化硬件控制：仅使用数字输出
-        if direction == 'forward':
-            GPIO.output(MOTOR_PINS["LEFT_FORWARD"], GPIO.HIGH)
-            GPIO.output(MOTOR_PINS["RIGHT_FORWARD"], GPIO.HIGH)
-        elif direction == 'backward':
-            GPIO.output(MOTOR_PINS["LEFT_BACKWARD"], GPIO.HIGH)
-            GPIO.output(MOTOR_PINS["RIGHT_BACKWARD"], GPIO.HIGH)
+        log.debug("Moving car: %s...", direction)
+        self._set_drive(direction)
         
         # 假设 1 步约 0.5 秒
         move_time = duration_steps * 0.5
-        asyncio.create_task(self._delay_stop(move_time))
+        self._schedule_stop(move_time)
         
     def _turn_car(self, direction: str, duration_degrees: int):
         """模拟/执行小车转向的硬件控制。"""
         if not self.hardware_initialized:
-            print(f"Mocking turn car: {direction} for {duration_degrees} degrees.")
+            log.debug("Mocking turn car: %s for %s degrees.", direction, duration_degrees)
             return
 
-        print(f"Turning car: {direction}...")
-        
-        if direction == 'left':
-            # 左轮后退，右轮前进
-            GPIO.output(MOTOR_PINS["LEFT_BACKWARD"], GPIO.HIGH)
-            GPIO.output(MOTOR_PINS["RIGHT_FORWARD"], GPIO.HIGH)
-        elif direction == 'right':
-            # 左轮前进，右轮后退
-            GPIO.output(MOTOR_PINS["LEFT_FORWARD"], GPIO.HIGH)
-            GPIO.output(MOTOR_PINS["RIGHT_BACKWARD"], GPIO.HIGH)
+        log.debug("Turning car: %s...", direction)
+        self._set_drive(direction)
 
         # 假设 90 度约 0.8 秒
         turn_time = duration_degrees / 90 * 0.8
-        asyncio.create_task(self._delay_stop(turn_time))
+        self._schedule_stop(turn_time)
 
     def _stop_car(self):
         """停止所有电机。"""
-        print("Stopping car.")
+        log.debug("Stopping car.")
+        self._cancel_stop_timer()
         if self.hardware_initialized:
-            for pin in MOTOR_PINS.values():
-                GPIO.output(pin, GPIO.LOW)
+            self._set_drive('stop')
+
+    def _set_drive(self, motion: str):
+        """按查表结果一次性设置四个方向引脚；电平与上次相同时不重复写入。"""
+        levels = DRIVE_LEVELS[motion]
+        if levels == self._drive_levels:
+            return
+        GPIO.output(DRIVE_PINS, levels)
+        self._drive_levels = levels
     
-    async def _delay_stop(self, delay: float):
-        """异步延迟后停止电机。"""
-        await asyncio.sleep(delay)
-        self._stop_car()
+    def _schedule_stop(self, delay: float):
+        """(重新) 设置自动停车定时器，到期后停止电机。"""
+        self._cancel_stop_timer()
+        self._stop_timer = asyncio.get_running_loop().call_later(delay, self._stop_car)
+
+    def _cancel_stop_timer(self):
+        """取消尚未触发的自动停车定时器。"""
+        if self._stop_timer is not None:
+            self._stop_timer.cancel()
+            self._stop_timer = None
 
     async def run_client(self):
         """启动小车端的主循环。"""
+        self._stop_event = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, self._stop_event.set)
+            except (NotImplementedError, RuntimeError):
+                pass # 部分平台 (如 Windows) 不支持，退回 KeyboardInterrupt
+
         self._init_hardware()
 
         # 1. 连接服务端
-        conn = await self.comm_manager.establish_connection()
+        # 接收循环由 _handle_incoming_messages 负责，不再启动 CommManager 的监听任务，
+        # 保证每条文本消息只被解析一次
+        conn = await self.comm_manager.establish_connection(start_listener=False)
         if not conn:
-            print("Failed to establish connection. Retrying in 5 seconds...")
-            await asyncio.sleep(5)
-            # 简化处理：这里直接退出，实际应实现重连逻辑
+            # 重试已在 WebSocketClient.connect 中按指数退避完成
+            log.error("Failed to establish connection after retries. Exiting.")
             return
 
         # 2. 启动音频流 I/O
@@ -194,74 +245,96 @@ class CarController:
         self.mic_stream_task = asyncio.create_task(
             self.mic_client.stream_audio_to_server(conn)
         )
-        # TTS 语音流接收在 CommManager 的 listener_task 中，通过 SpeakerClient 的 receive_and_play_audio 处理
-        # Note: 由于 websockets API 的限制，我们不能在一个连接上同时跑 listen_for_control_commands 和 MicClient.stream_audio_to_server 
-        # 并用另一个 Task 来处理二进制消息。这里我们假设 conn.recv() 会在 comm_client 内部处理控制消息，
-        # 而 MicClient.stream_audio_to_server 仅负责发送。
-        # 实际 websockets 双向流中，conn 既能 send 也能在 async for message in conn 中接收。
-        
-        # 为了让 SpeakerClient 接收二进制消息 (PCM)，我们需要让 CommManager 的 listener task 
-        # 将接收到的二进制消息转发给 SpeakerClient。
-        # **为了匹配文档结构和简化，我们重写一个 Task 来处理 Speaker/Control 接收：**
+        # 同一连接上只能有一个接收循环：MicClient 只负责发送，
+        # _handle_incoming_messages 统一接收 PCM (交给 SpeakerClient) 与控制消息 (交给动作执行)
         self.speaker_stream_task = asyncio.create_task(
             self._handle_incoming_messages(conn)
         )
         
-        print("PetCar client started. Waiting for user interaction...")
+        log.info("PetCar client started. Waiting for user interaction...")
         
         # 3. 保持运行，直到连接关闭或用户中断
         try:
-            # 保持主循环运行
-            while self.comm_manager.audio_control_client.is_connected:
-                await asyncio.sleep(1) 
+            stop_wait = asyncio.create_task(self._stop_event.wait())
+            disconnect_wait = asyncio.create_task(
+                self.comm_manager.audio_control_client.disconnected.wait()
+            )
+            try:
+                await asyncio.wait({stop_wait, disconnect_wait}, return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                stop_wait.cancel()
+                disconnect_wait.cancel()
         except asyncio.CancelledError:
-            print("Main loop cancelled.")
+            log.info("Main loop cancelled.")
         finally:
             await self._shutdown()
             
     async def _handle_incoming_messages(self, conn):
-        """替代 CommManager.listen_for_control_commands，处理所有接收消息。"""
+        """连接上唯一的接收循环，替代 CommManager.listen_for_control_commands 处理所有接收消息。"""
+        client = self.comm_manager.audio_control_client
         try:
             async for message in conn:
                 if isinstance(message, bytes):
-                    # PCM 音频流，交给 SpeakerClient 播放
-                    # Note: 这里必须用 loop.run_in_executor 来包装阻塞的 stream.write()
-                    loop = asyncio.get_running_loop()
-                    await loop.run_in_executor(None, self.speaker_client.stream.write, message)
-                elif isinstance(message, str):
-                    # JSON 控制/文本消息
-                    frame = parse_frame(message)
-                    if isinstance(frame, ControlCmd):
-                        await self.execute_action_command(frame)
-                    # elif isinstance(frame, StatusMsg): ...
+                    # PCM 音频流，放入 SpeakerClient 的播放队列，由其写入线程播放
+                    self.speaker_client.enqueue_chunk(message)
+                else:
+                    # JSON 控制/状态消息：解析一次后分发给 execute_action_command
+                    await client.dispatch_text(message)
         except websockets.exceptions.ConnectionClosed:
-            print("Incoming message handler detected connection closed.")
+            log.info("Incoming message handler detected connection closed.")
         except Exception as e:
-            print(f"Error in incoming message handler: {e}")
+            log.error("Error in incoming message handler: %s", e)
+        finally:
+            # 连接断开后不再有新指令，立即停车，而不是等待自动停车定时器到期
+            self._stop_car()
+            client.mark_disconnected()
         
     async def _shutdown(self):
         """清理资源并优雅退出。"""
-        print("\nInitiating client shutdown...")
+        if self._shutdown_done:
+            return
+        self._shutdown_done = True
+        log.info("Initiating client shutdown...")
         
-        if self.mic_stream_task:
-            self.mic_stream_task.cancel()
-        if self.speaker_stream_task:
-            self.speaker_stream_task.cancel()
+        # 取消后台任务，并在限定时间内等待它们真正退出 (执行各自的 finally 清理)
+        tasks = [t for t in (self.mic_stream_task, self.speaker_stream_task) if t]
+        for task in tasks:
+            task.cancel()
+        if tasks:
+            try:
+                await asyncio.wait_for(
+                    asyncio.gather(*tasks, return_exceptions=True), timeout=SHUTDOWN_TIMEOUT_S
+                )
+            except asyncio.TimeoutError:
+                log.warning("background tasks did not exit in time.")
             
         await self.comm_manager.close_connection()
         self.mic_client.stop_stream()
         self.speaker_client.terminate()
         self._cleanup_hardware()
-        print("PetCar client shutdown complete.")
+        log.info("PetCar client shutdown complete.")
 
 
 if __name__ == '__main__':
+    # 日志级别可通过环境变量调整；逐帧/逐指令的消息为 DEBUG 级别，默认不输出
+    logging.basicConfig(
+        level=os.environ.get("PETCAR_LOG_LEVEL", "INFO").upper(),
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
+    # 可选：使用 uvloop 替换默认事件循环，提升 WebSocket 音频流的吞吐
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        log.info("Using uvloop event loop.")
+    except ImportError:
+        pass
+
     controller = CarController()
     try:
         asyncio.run(controller.run_client())
     except KeyboardInterrupt:
-        print("\nClient interrupted by user.")
-        # 确保在 KeyboardInterrupt 发生时执行清理
-        asyncio.run(controller._shutdown())
-    except Exception as e:
-        print(f"Unhandled exception in main: {e}")
+        # 信号处理器不可用的平台：asyncio.run 已取消主任务，run_client 的 finally 完成清理
+        log.info("Client interrupted by user.")
+    except Exception:
+        log.exception("Unhandled exception in main")
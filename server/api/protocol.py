@@ -1,6 +1,21 @@
+import functools
 import json
+import sys
 from typing import Dict, Any, Optional
-from dataclasses import dataclass, asdict
+from dataclasses import dataclass
+
+# 可选：使用 orjson 加速 JSON 序列化/解析 (未安装时回退到标准库 json)
+try:
+    import orjson
+    _json_loads = orjson.loads
+
+    def _json_dumps(obj: Dict[str, Any]) -> str:
+        return orjson.dumps(obj).decode()
+except ImportError:
+    _json_loads = json.loads
+
+    def _json_dumps(obj: Dict[str, Any]) -> str:
+        return json.dumps(obj, ensure_ascii=False, separators=(',', ':'))
 
 # 定义 PetCar AI 项目的通信数据协议。
 # 所有数据帧都应能被 JSON 序列化和反序列化，
@@ -13,12 +28,15 @@ INITIAL_SEQ = 0
 AUDIO_IN_RATE = 16000 
 # 服务端下发音频的采样率 (TTS 输出)
 AUDIO_OUT_RATE = 24000 
-# 采样精度 (16-bit)
-AUDIO_DTYPE = 'int16' 
+# 采样精度 (16-bit, 小端字节序)
+AUDIO_DTYPE = '<i2' 
 
 # --- 数据帧定义 ---
 
-@dataclass
+# dataclass(slots=True) 需要 Python 3.10+；小车端 (Python 3.9) 也会导入本模块，低版本时退回普通 dataclass
+_DATACLASS_KWARGS = {'slots': True} if sys.version_info >= (3, 10) else {}
+
+@dataclass(**_DATACLASS_KWARGS)
 class AudioFrame:
     """
     用于传输音频 PCM 数据的帧结构。
@@ -38,12 +56,10 @@ class AudioFrame:
         # Note: 实际应用中，音频流通常直接通过 WebSocket 的 binary 消息传输，
         # 只有控制信息（如 seq, is_final）可能通过 JSON header 传输。
         # 这里的实现是简化版，假设控制信息通过 JSON 传输。
-        data = asdict(self)
-        # 移除 pcm_data，因为它通常作为二进制消息的 payload 独立传输
-        del data['pcm_data'] 
-        return json.dumps(data)
+        # 不包含 pcm_data，因为它通常作为二进制消息的 payload 独立传输
+        return _json_dumps({"seq": self.seq, "is_final": self.is_final})
 
-@dataclass
+@dataclass(**_DATACLASS_KWARGS)
 class TextFrame:
     """
     用于传输文本信息，如 ASR 结果、LLM 回复或系统消息。
@@ -60,10 +76,10 @@ class TextFrame:
 
     def to_json(self) -> str:
         """将 TextFrame 序列化为 JSON 字符串。"""
-        return json.dumps(asdict(self))
+        return _json_dumps({"seq": self.seq, "text": self.text, "type": self.type, "is_final": self.is_final})
 
 
-@dataclass
+@dataclass(**_DATACLASS_KWARGS)
 class ControlCmd:
     """
     用于传输小车动作指令或系统控制命令。
@@ -79,10 +95,19 @@ class ControlCmd:
 
     def to_json(self) -> str:
         """将 ControlCmd 序列化为 JSON 字符串。"""
-        return json.dumps(asdict(self))
+        if self.extra is None:
+            # 无额外参数的指令 (如反复下发的 'forward(5)') 命中缓存，直接复用已序列化的字符串
+            return _dump_control(self.type, self.value)
+        return _json_dumps({"type": self.type, "value": self.value, "extra": self.extra})
+
+
+@functools.lru_cache(maxsize=256)
+def _dump_control(type_: str, value: str) -> str:
+    """序列化不带 extra 的 ControlCmd，结果按 (type, value) 缓存。"""
+    return _json_dumps({"type": type_, "value": value, "extra": None})
 
 
-@dataclass
+@dataclass(**_DATACLASS_KWARGS)
 class StatusMsg:
     """
     用于传输状态或错误信息。
@@ -97,7 +122,17 @@ class StatusMsg:
 
     def to_json(self) -> str:
         """将 StatusMsg 序列化为 JSON 字符串。"""
-        return json.dumps(asdict(self))
+        return _json_dumps({"code": self.code, "message": self.message, "ref_seq": self.ref_seq})
+
+
+# 帧类型分发表 (预先构建)：(必需字段集合, 帧类)，按顺序匹配，顺序即优先级
+# 注意：由于 pcm_data 通常是二进制，AudioFrame 分支需要根据实际WebSocket传输模式调整
+_FRAME_DISPATCH = (
+    (frozenset({'pcm_data'}), AudioFrame),
+    (frozenset({'text', 'type'}), TextFrame),
+    (frozenset({'type', 'value'}), ControlCmd),
+    (frozenset({'code', 'message'}), StatusMsg),
+)
 
 
 def parse_frame(data: str) -> Optional[Any]:
@@ -108,23 +143,19 @@ def parse_frame(data: str) -> Optional[Any]:
     :return: 对应的协议 dataclass 实例或 None。
     """
     try:
-        data_dict = json.loads(data)
-        
-        # 简单的类型判断，根据关键字段区分帧类型
-        if 'pcm_data' in data_dict:
-             # 注意：由于 pcm_data 通常是二进制，这个逻辑需要根据实际WebSocket传输模式调整
-             # 假设客户端只发送控制 JSON 头
-             return AudioFrame(**data_dict)
-        elif 'text' in data_dict and 'type' in data_dict:
-            return TextFrame(**data_dict)
-        elif 'type' in data_dict and 'value' in data_dict:
-            return ControlCmd(**data_dict)
-        elif 'code' in data_dict and 'message' in data_dict:
-            return StatusMsg(**data_dict)
-            
+        data_dict = _json_loads(data)
+        if not isinstance(data_dict, dict):
+            return None
+
+        # 按优先级查分发表：必需字段是消息字段的子集即命中
+        keys = data_dict.keys()
+        for required, cls in _FRAME_DISPATCH:
+            if required <= keys:
+                return cls(**data_dict)
+
         return None
         
-    except json.JSONDecodeError:
+    except json.JSONDecodeError: # orjson.JSONDecodeError 是其子类
         print(f"Protocol Error: Cannot decode JSON data: {data[:50]}...")
         return None
     except TypeError as e:
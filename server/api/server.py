@@ -1,13 +1,35 @@
 import asyncio
 import websockets
 from websockets.server import WebSocketServerProtocol
-from typing import Dict, Any, Optional
+from websockets.protocol import State
+from typing import AsyncIterator, Dict, Any, Generator, Optional, Iterable, List, Set, Union
 
 # 导入协议和核心逻辑
 from server.api.protocol import ControlCmd, AudioFrame, StatusMsg
 from server.pipeline.conversation import ConversationPipeline
 from server.pipeline.streaming_manager import AudioQueue, PCMQueue
 
+# PCM 下行合并发送：在短时间窗口内把多个 TTS 小块合并为一条 WebSocket 二进制消息
+PCM_SEND_BATCH_BYTES = 32 * 1024   # 单条消息最多合并的字节数
+PCM_SEND_BATCH_WINDOW_S = 0.01     # 首块到达后最多等待的合并时间 (秒)
+
+# WebSocket 服务参数：PCM 二进制流不可压缩，关闭 per-message deflate 以省去每帧 zlib 开销；
+# 控制通道的 JSON 消息很小，不压缩同样无妨。放宽消息大小与写缓冲，避免 TTS 突发时误触发背压。
+WS_SERVE_OPTIONS: Dict[str, Any] = {
+    "compression": None,
+    "max_size": 2 ** 22,
+    "write_limit": 2 ** 20,
+    "ping_interval": 20,
+    "ping_timeout": 20,
+}
+
+# 上行音频批量入队：每次最多额外取走的后续消息数，以及等待每条后续消息的最长时间 (秒)
+AUDIO_IN_DRAIN_MAX = 8
+AUDIO_IN_DRAIN_TIMEOUT_S = 0.001
+
+# 广播分批：每批并发发送的连接数，批与批之间让出事件循环，避免大量订阅者时阻塞
+BROADCAST_BATCH_SIZE = 50
+
 # 假设 AudioFrame 的 PCM 数据是作为单独的二进制消息发送的。
 # 我们只通过 JSON 消息来传输控制信息（如 seq, is_final）。
 # 实际的 pcm_data 会通过 WebSocket 的 Message.data 二进制部分获取。
@@ -24,6 +46,8 @@ class PetCarServer:
         self.pipeline = pipeline
         # 存储当前活动的连接 (小车端连接)
         self.car_connection: Optional[WebSocketServerProtocol] = None 
+        # 所有已建立的连接 (用于广播控制指令等扇出消息)
+        self.clients: Set[WebSocketServerProtocol] = set()
         # 存储当前的音频输入队列 (如果有活跃会话)
         self.current_audio_queue: Optional[AudioQueue] = None 
         # 存储当前的 PCM 输出队列 (如果有活跃会话)
@@ -41,6 +65,7 @@ class PetCarServer:
 
         print(f"New connection established on path: {path}")
         self.car_connection = websocket
+        self.clients.add(websocket)
         
         try:
             if path == "/audio/in":
@@ -58,6 +83,7 @@ class PetCarServer:
             print(f"Connection closed by client on path: {path}")
         finally:
             self.car_connection = None
+            self.clients.discard(websocket)
             # 确保流被清理
             if self.pipeline.is_active():
                 self.pipeline.manager.close_all()
@@ -82,9 +108,9 @@ class PetCarServer:
         try:
             async for message in websocket:
                 if isinstance(message, bytes):
-                    # PCM 数据通过二进制消息直接传输
+                    # PCM 数据通过二进制消息直接传输；顺带取走已到达的后续消息，批量入队
                     if self.current_audio_queue:
-                        await self.current_audio_queue.put(message)
+                        await self.current_audio_queue.put_many(await self._drain_ready_audio(websocket, message))
                 elif isinstance(message, str):
                     # 也可以处理 JSON 控制消息，例如 AudioFrame 的 is_final 标记
                     # 实际操作中，通常是客户端发送一个 control frame
@@ -109,6 +135,26 @@ class PetCarServer:
                 print(f"Error during pipeline execution cleanup: {e}")
 
 
+    @staticmethod
+    async def _drain_ready_audio(websocket: WebSocketServerProtocol, first: bytes) -> List[bytes]:
+        """
+        取出连接上紧随首条消息到达的后续二进制消息 (最多 AUDIO_IN_DRAIN_MAX 条)，一起批量入队。
+        只通过公开的 recv() 读取，每次最多等待 AUDIO_IN_DRAIN_TIMEOUT_S，超时即视为暂无后续消息；
+        websockets 保证被取消的 recv() 不会丢失消息。
+        """
+        batch = [first]
+        while len(batch) <= AUDIO_IN_DRAIN_MAX:
+            try:
+                message = await asyncio.wait_for(websocket.recv(), AUDIO_IN_DRAIN_TIMEOUT_S)
+            except (asyncio.TimeoutError, websockets.exceptions.ConnectionClosed):
+                # 连接关闭时先交付已取到的数据，由外层 async for 处理关闭
+                break
+            if isinstance(message, bytes):
+                batch.append(message)
+            # 文本消息与逐条接收时一样被忽略
+        return batch
+
+
     async def _run_conversation_pipeline(self, audio_in_websocket: WebSocketServerProtocol):
         """
         辅助任务：运行核心的 ASR/LLM/TTS 流程，并同步启动 TTS 输出的推送任务。
@@ -131,17 +177,14 @@ class PetCarServer:
         将 TTS 生成的 PCM 音频流推送到小车端。
         """
         print("Starting PCM output stream pusher...")
-        seq_counter = 0
         try:
-            async for pcm_chunk in pcm_queue:
-                # 1. 发送控制信息（JSON 文本）
-                # 这里假设控制信息（如 seq）是可选的，直接发送二进制 PCM
-                # control_frame = AudioFrame(seq=seq_counter, pcm_data=b'', is_final=False)
-                # await websocket.send(control_frame.to_json())
-                
-                # 2. 发送 PCM 数据（二进制）
-                await websocket.send(pcm_chunk)
-                seq_counter += 1
+            while await pcm_queue.wait_readable():
+                # 1. 不足一批时在合并窗口内等待后续数据块，凑成一条消息
+                if pcm_queue.nbytes < PCM_SEND_BATCH_BYTES and not pcm_queue.is_finished:
+                    await asyncio.sleep(PCM_SEND_BATCH_WINDOW_S)
+
+                # 2. 跨块取出一批 PCM 数据并发送（二进制），只在拼接时复制一次
+                await websocket.send(pcm_queue.read_nowait(PCM_SEND_BATCH_BYTES))
                 
         except asyncio.CancelledError:
             print("PCM pusher task cancelled.")
@@ -149,9 +192,11 @@ class PetCarServer:
         except websockets.exceptions.ConnectionClosed:
             print("Client closed connection during PCM push.")
         finally:
-            # 发送一个最终帧标记（可选，如果客户端需要明确知道流结束）
-            # final_frame = AudioFrame(seq=seq_counter, pcm_data=b'', is_final=True)
-            # await websocket.send(final_frame.to_json())
+            # 推送端退出 (连接断开/被取消) 后不再有人读取：关闭队列，TTS 后续的 put 直接丢弃，
+            # 否则有界队列写满后 TTS 会一直等待，流水线无法结束
+            pcm_queue.close()
+            # 如需让客户端明确知道流结束，应单独发送一条 JSON 控制帧（AudioFrame is_final=True），
+            # 而不是把元数据夹在 PCM 二进制消息中
             print("PCM output stream pusher finished.")
 
 
@@ -159,16 +204,43 @@ class PetCarServer:
         """
         将 LLM 提取的动作指令发送给小车端。
         """
-        if self.car_connection:
-            try:
-                # 构造动作指令帧
-                cmd = ControlCmd(type='action', value=action_cmd_value)
-                await self.car_connection.send(cmd.to_json())
-                print(f"ControlCmd sent: {cmd.value}")
-            except websockets.exceptions.ConnectionClosed:
-                print("Cannot send ControlCmd: Connection is closed.")
-        else:
+        if not self.clients:
             print("ControlCmd failed: Car connection not found.")
+            return
+
+        # 构造动作指令帧，通过广播发送给所有连接
+        cmd = ControlCmd(type='action', value=action_cmd_value)
+        if await self._broadcast(cmd.to_json()):
+            print(f"ControlCmd sent: {cmd.value}")
+        else:
+            print("Cannot send ControlCmd: Connection is closed.")
+
+
+    async def _broadcast(self, payload: Union[str, bytes],
+                         clients: Optional[Iterable[WebSocketServerProtocol]] = None) -> int:
+        """
+        将同一消息分批并发发送给多个连接 (默认所有已连接客户端)。
+
+        每批最多 BROADCAST_BATCH_SIZE 个连接，批与批之间 sleep(0) 让出事件循环；
+        已关闭或发送失败的连接被跳过，并在同一轮中从 self.clients 移除。返回成功发送的连接数。
+        """
+        targets = []
+        for c in list(self.clients if clients is None else clients):
+            if c.state is State.OPEN:
+                targets.append(c)
+            else:
+                self.clients.discard(c)
+        sent = 0
+        for i in range(0, len(targets), BROADCAST_BATCH_SIZE):
+            batch = targets[i:i + BROADCAST_BATCH_SIZE]
+            results = await asyncio.gather(*(c.send(payload) for c in batch), return_exceptions=True)
+            for c, r in zip(batch, results):
+                if isinstance(r, BaseException):
+                    self.clients.discard(c)
+                else:
+                    sent += 1
+            await asyncio.sleep(0)
+        return sent
 
 
     async def _audio_out_handler(self, websocket: WebSocketServerProtocol):
@@ -200,7 +272,8 @@ class PetCarServer:
         start_server = websockets.serve(
             self._handle_connection, 
             self.host, 
-            self.port
+            self.port,
+            **WS_SERVE_OPTIONS
         )
         print(f"WebSocket Server starting at ws://{self.host}:{self.port}")
         
@@ -221,6 +294,7 @@ if __name__ == '__main__':
             return "小车小车，前进。" if len(chunk) > 4096 * 5 else None
         def end_stream(self) -> Optional[str]: return "最终识别结果"
         def detect_wakeup_word(self, text: str) -> bool: return self.wakeup_word in text
+        def scan_wakeup_word(self, text: str) -> bool: return self.wakeup_word in text
     class MockLLM:
         def __init__(self, *args, **kwargs): self.history = []
         def chat_stream(self, text: str) -> Generator[str, None, None]: 
@@ -229,6 +303,10 @@ if __name__ == '__main__':
             for char in response:
                 time.sleep(0.01)
                 yield char
+        async def chat_stream_async(self, text: str) -> AsyncIterator[str]:
+            from server.models.stream_utils import iterate_in_thread
+            async for chunk in iterate_in_thread(self.chat_stream, text):
+                yield chunk
         def clear_history(self): pass
     class MockTTS:
         def __init__(self, *args, **kwargs): pass
@@ -237,6 +315,10 @@ if __name__ == '__main__':
             for _ in range(5):
                 time.sleep(0.02)
                 yield b'\x00' * 4096
+        async def synthesize_stream_async(self, text: str) -> AsyncIterator[bytes]:
+            from server.models.stream_utils import iterate_in_thread
+            async for pcm_chunk in iterate_in_thread(self.synthesize_stream, text):
+                yield pcm_chunk
             
     from server.pipeline.conversation import ConversationPipeline as MockPipeline
     mock_pipeline = MockPipeline(MockASR(), MockLLM(), MockTTS())
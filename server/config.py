@@ -26,16 +26,21 @@ ASR_CONFIG: Dict[str, Any] = {
     "wakeup_word": "小车小车",
     "sample_rate": 16000,
     "channels": 1,
+    "gate_rms_threshold": 300.0,   # 静音门控 RMS 阈值 (int16 幅度)，静音块不送入模型
+    "gate_hangover_chunks": 10,    # 连续静音多少块后开始跳过模型
 }
 
 # 2. LLM 模型配置 (Qwen3-1.7B 量化版)
 LLM_CONFIG: Dict[str, Any] = {
     "model_path": os.path.join(MODEL_DIR, "qwen3/Qwen3-1.8B-Int4"),
     "quantization_config": {
-        "load_in_4bit": True,      # 启用 4-bit 量化加载
-        "bnb_4bit_compute_dtype": "torch.bfloat16",
-        # ... 其他量化参数
+        "mode": "nf4",             # 权重量化方式：'int8' (W8A16)、'nf4' (W4A16)；None 表示不量化
+        "llm_int8_threshold": 6.0, # int8 离群值阈值
+        "bnb_4bit_use_double_quant": True, # nf4 时对量化常数再做一次量化，进一步节省显存
     },
+    "fuse_qkv": False,            # 合并每层 Q/K/V 投影 (仅未量化时生效)
+    "compile_decode": False,      # torch.compile + 静态 KV cache 编译解码步 (仅 CUDA，启动时间变长)
+    "num_threads": None,          # CPU 推理线程数 (torch.set_num_threads，进程级)；None 表示保持 PyTorch 默认
     "max_length": 512,            # 最大生成长度
     "temperature": 0.7,           # 采样温度
 }
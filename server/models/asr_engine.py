@@ -1,6 +1,8 @@
 import os
 import time
-from typing import Generator, Optional
+from typing import Generator, Optional, Union
+
+import numpy as np
 
 # 假设 SenseVoice SDK 的导入方式
 # 实际部署时，可能需要替换为真实的 SenseVoice Python SDK
@@ -16,19 +18,20 @@ except ImportError:
 
         def create_stream(self, sample_rate, channels):
             # 模拟创建流式识别会话
-            self.stream_state = {"buffer": b"", "timestamp": time.time()}
+            self.stream_state = {"buffered": 0, "timestamp": time.monotonic()}
             return self
 
         def process_chunk(self, audio_chunk) -> Optional[str]:
             # 模拟流式识别
-            self.stream_state["buffer"] += audio_chunk
+            # 只累计字节数，不拼接音频数据
+            self.stream_state["buffered"] += memoryview(audio_chunk).nbytes
             # 假设每处理 4096 字节音频，就可能产生一个结果
-            if len(self.stream_state["buffer"]) >= 4096 * 4: # 假设 16k 16bit mono, 4096*4 约 512ms
-                self.stream_state["buffer"] = b"" # 清空缓冲区
-                if time.time() - self.stream_state["timestamp"] < 5:
+            if self.stream_state["buffered"] >= 4096 * 4: # 假设 16k 16bit mono, 4096*4 约 512ms
+                self.stream_state["buffered"] = 0 # 清空缓冲区
+                if time.monotonic() - self.stream_state["timestamp"] < 5:
                     return None # 模拟中间结果
                 else:
-                    self.stream_state["timestamp"] = time.time() # 重置时间
+                    self.stream_state["timestamp"] = time.monotonic() # 重置时间
                     # 模拟 ASR 结果，包含触发词和命令
                     mock_results = [
                         "小车小车",
@@ -46,28 +49,55 @@ except ImportError:
             # 模拟流结束时的最终结果
             self.stream_state = None
             return "最终结果"
-    
+
+# 静音门控配置：连续静音时不调用模型，静音音频暂存在环形缓冲中
+ASR_GATE_RMS_THRESHOLD = 300.0   # RMS 阈值 (int16 幅度)，低于该值视为静音
+ASR_GATE_ZCR_MIN_RATE = 0.02     # 每个采样点的最小过零率，低于该值视为直流/低频噪声
+ASR_GATE_HANGOVER_CHUNKS = 10    # 连续 N 块静音后才开始跳过模型 (约 320ms @ 1024 字节/块)
+ASR_GATE_RING_SECONDS = 2        # 暂存的静音音频时长上限，语音重新出现时随当前块一起送入模型
+
+# 线上 PCM 格式：16-bit 小端。显式指定字节序，小端主机上与 int16 相同 (零拷贝)，
+# 大端主机上由 numpy 在 C 层完成字节序转换，无需逐采样处理
+PCM_DTYPE = np.dtype('<i2')
+
+
 class ASREngine:
     """
     SenseVoice (ASR) 模型引擎。
     负责流式语音转写和触发词检测。
     """
     
-    def __init__(self, model_path: str, wakeup_word: str = "小车小车"):
+    def __init__(self, model_path: str, wakeup_word: str = "小车小车",
+                 gate_rms_threshold: float = ASR_GATE_RMS_THRESHOLD,
+                 gate_hangover_chunks: int = ASR_GATE_HANGOVER_CHUNKS):
         """
         初始化 ASR 引擎。
         :param model_path: SenseVoice 模型文件路径。
         :param wakeup_word: 唤醒词。
+        :param gate_rms_threshold: 静音门控的 RMS 阈值。
+        :param gate_hangover_chunks: 连续多少块静音后开始跳过模型。
         """
         print(f"Initializing ASREngine with model: {model_path}")
         # 在真实环境中，这里会加载 SenseVoice 模型
         self.model = SenseVoiceModel(model_path) 
         self.wakeup_word = wakeup_word
+        # 唤醒词检测前需要去掉的标点和空白，预先构建 str.translate 删除表
+        self._strip_table = str.maketrans('', '', '，。 、,.\t\n')
+        # 流式唤醒词检测保留的尾部 (不足一个唤醒词长度)，用于匹配跨两次结果的唤醒词
+        self._wakeup_tail = ""
         # 设置音频参数
         self.sample_rate = 16000
         self.channels = 1
         self.stream_instance = None
 
+        # 静音门控状态：预分配的 int16 环形缓冲，保存被跳过的最近音频
+        self.gate_rms_threshold = gate_rms_threshold
+        self.gate_hangover_chunks = gate_hangover_chunks
+        self._ring = np.zeros(self.sample_rate * ASR_GATE_RING_SECONDS, dtype=PCM_DTYPE)
+        self._ring_head = 0   # 下一个写入位置
+        self._ring_held = 0   # 环中尚未送入模型的采样数
+        self._silent_chunks = 0
+
 
     def start_stream(self):
         """
@@ -76,6 +106,8 @@ class ASREngine:
         if self.stream_instance:
             self.end_stream()
         
+        self._reset_gate()
+        self._wakeup_tail = ""
         # 实际调用 SenseVoice 的 create_stream 方法
         self.stream_instance = self.model.create_stream(
             sample_rate=self.sample_rate, 
@@ -84,22 +116,84 @@ class ASREngine:
         print("ASR Stream started.")
 
 
-    def transcribe_stream(self, audio_chunk: bytes) -> Optional[str]:
+    def transcribe_stream(self, audio_chunk: Union[bytes, bytearray, memoryview]) -> Optional[str]:
         """
         处理一段音频数据，返回转写文本（可能是中间结果或最终结果）。
         
-        :param audio_chunk: PCM 格式音频数据块。
+        :param audio_chunk: PCM 格式音频数据块，可以是 bytes 或任意连续缓冲 (bytearray/memoryview)，不做复制。
         :return: 转写出的文本，如果没有新结果则返回 None。
         """
         if not self.stream_instance:
             raise RuntimeError("ASR stream not started. Call start_stream() first.")
         
+        if memoryview(audio_chunk).nbytes % 2 == 0:
+            samples = np.frombuffer(audio_chunk, dtype=PCM_DTYPE) # 零拷贝视图
+            if self._is_speech(samples):
+                self._silent_chunks = 0
+            else:
+                self._silent_chunks += 1
+
+            # 持续静音：只写入环形缓冲，不调用模型
+            if self._silent_chunks > self.gate_hangover_chunks:
+                self._hold(samples)
+                return None
+
+            # 语音重新出现：把暂存的静音尾部与当前块一起送入模型，保持音频连续
+            if self._ring_held:
+                audio_chunk = np.concatenate((self._take_held(), samples)).tobytes()
+
         # 实际调用 SenseVoice 的 process_chunk 方法
         text = self.stream_instance.process_chunk(audio_chunk)
         
         return text
 
 
+    def _is_speech(self, samples: np.ndarray) -> bool:
+        """基于 RMS 能量和过零率的轻量语音判断。"""
+        if samples.size == 0:
+            return False
+        x = samples.astype(np.float32)
+        rms = float(np.sqrt(np.mean(x * x)))
+        if rms < self.gate_rms_threshold:
+            return False
+        sign = np.signbit(samples)
+        zcr = int(np.count_nonzero(sign[1:] != sign[:-1]))
+        return zcr >= samples.size * ASR_GATE_ZCR_MIN_RATE
+
+
+    def _hold(self, samples: np.ndarray):
+        """将被跳过的音频写入环形缓冲，超出容量时覆盖最旧的数据。"""
+        cap = self._ring.size
+        if samples.size >= cap:
+            samples = samples[-cap:]
+        n = samples.size
+        head = self._ring_head
+        first = min(n, cap - head)
+        self._ring[head:head + first] = samples[:first]
+        self._ring[:n - first] = samples[first:]
+        self._ring_head = (head + n) % cap
+        self._ring_held = min(self._ring_held + n, cap)
+
+
+    def _take_held(self) -> np.ndarray:
+        """按时间顺序取出环形缓冲中暂存的音频，并清空暂存计数。"""
+        start = (self._ring_head - self._ring_held) % self._ring.size
+        end = start + self._ring_held
+        if end <= self._ring.size:
+            held = self._ring[start:end]
+        else:
+            held = np.concatenate((self._ring[start:], self._ring[:end - self._ring.size]))
+        self._ring_held = 0
+        return held
+
+
+    def _reset_gate(self):
+        """重置静音门控状态 (新会话开始/结束时调用)。"""
+        self._ring_head = 0
+        self._ring_held = 0
+        self._silent_chunks = 0
+
+
     def end_stream(self) -> Optional[str]:
         """
         结束当前的流式转写会话，获取最终结果。
@@ -110,6 +204,7 @@ class ASREngine:
         # 实际调用 SenseVoice 的 end_stream 方法
         final_text = self.stream_instance.end_stream()
         self.stream_instance = None
+        self._reset_gate()
         print("ASR Stream ended.")
         return final_text
     
@@ -124,8 +219,8 @@ class ASREngine:
         if not text:
             return False
             
-        # 简单的字符串匹配
-        is_detected = self.wakeup_word in text.replace('，', '').replace('。', '').replace(' ', '')
+        # 一次 translate 去掉标点和空白后做简单的字符串匹配
+        is_detected = self.wakeup_word in text.translate(self._strip_table)
         
         if is_detected:
             print(f"Wakeup word '{self.wakeup_word}' detected in: '{text}'")
@@ -133,6 +228,28 @@ class ASREngine:
         return is_detected
 
 
+    def scan_wakeup_word(self, new_text: str) -> bool:
+        """
+        流式唤醒词检测：只扫描上次保留的尾部 + 新的转写文本，
+        每次开销与新文本长度成正比，不随累计的转写结果增长。
+
+        :param new_text: 本次 ASR 新产生的文本片段。
+        :return: 如果唤醒词出现 (包括跨越前后两段文本) 则返回 True。
+        """
+        if not new_text:
+            return False
+
+        window = self._wakeup_tail + new_text.translate(self._strip_table)
+        if self.wakeup_word in window:
+            self._wakeup_tail = ""
+            print(f"Wakeup word '{self.wakeup_word}' detected in: '{new_text}'")
+            return True
+
+        keep = len(self.wakeup_word) - 1
+        self._wakeup_tail = window[-keep:] if keep > 0 else ""
+        return False
+
+
 if __name__ == '__main__':
     # 示例用法
     # 假设模型的配置在 config.py 中
@@ -144,8 +261,9 @@ if __name__ == '__main__':
     asr_engine.start_stream()
     
     # 假设音频采样率为 16000 Hz, 16-bit PCM, 单声道
-    # 1024 字节约为 32ms 的音频
-    audio_chunk = b'\x00' * 1024
+    # 1024 字节约为 32ms 的音频。用 500Hz 正弦波代替全零数据，使其通过静音门控、真正送入模型
+    t = np.arange(512) / asr_engine.sample_rate
+    audio_chunk = (3000 * np.sin(2 * np.pi * 500 * t)).astype(PCM_DTYPE).tobytes()
     
     print("\n--- Simulating 10 seconds of streaming audio ---")
     for i in range(300): # 300 chunks * 32ms ~= 9.6 seconds
@@ -156,7 +274,7 @@ if __name__ == '__main__':
         
         if result:
             print(f"[{i*0.032:.2f}s] Interim/Final Result: {result.strip()}")
-            if asr_engine.detect_wakeup_word(result):
+            if asr_engine.scan_wakeup_word(result):
                 print(">>> ASR DETECTED WAKEUP WORD. READY FOR COMMAND.")
 
     final_result = asr_engine.end_stream()
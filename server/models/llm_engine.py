@@ -1,13 +1,20 @@
+import asyncio
+import importlib.util
+import threading
 import time
-from typing import Generator, List, Dict, Any
+from typing import AsyncIterator, Generator, List, Dict, Any, Optional
+
+from server.models.stream_utils import iterate_in_thread
 
 # 假设使用 Hugging Face transformers 和 Qwen 库
 try:
-    from transformers import AutoModelForCausalLM, AutoTokenizer
+    from transformers import AutoModelForCausalLM, AutoTokenizer, BitsAndBytesConfig, DynamicCache, TextIteratorStreamer
+    from transformers import StoppingCriteria, StoppingCriteriaList
     import torch
     # 假设 Qwen3-1.7B 量化后模型加载
 except ImportError:
     print("Warning: transformers or torch not found. Using mock implementation for LLM.")
+    torch = None
     
     class MockTokenizer:
         def encode(self, text, *args, **kwargs):
@@ -22,31 +29,130 @@ except ImportError:
                 formatted_input += f"<{role}>: {msg['content']}\n"
             return formatted_input
 
+# 单轮回复最多生成的新 token 数
+LLM_MAX_NEW_TOKENS = 256
+# 跨轮复用的 KV cache 覆盖的最大 token 数，超过后丢弃缓存重新 prefill，限制显存占用
+LLM_KV_CACHE_MAX_TOKENS = 2048
+# 推导单轮对话模板时使用的占位内容
+_USER_SLOT = "{{__petcar_user__}}"
+_ASSISTANT_SLOT = "{{__petcar_assistant__}}"
+
+
+if torch is not None:
+    class _PackedQKVProjection(torch.nn.Module):
+        """
+        把一层注意力的 q_proj/k_proj/v_proj 合并为一次矩阵乘：替换 q_proj，
+        返回 Q，并暂存同一输入的 K/V 供随后调用的 k_proj/v_proj 直接取用。
+        """
+        def __init__(self, q: "torch.nn.Linear", k: "torch.nn.Linear", v: "torch.nn.Linear"):
+            super().__init__()
+            self.split_sizes = (q.out_features, k.out_features, v.out_features)
+            self.weight = torch.nn.Parameter(torch.cat([q.weight, k.weight, v.weight], dim=0), requires_grad=False)
+            if q.bias is not None:
+                self.bias = torch.nn.Parameter(torch.cat([q.bias, k.bias, v.bias], dim=0), requires_grad=False)
+            else:
+                self.bias = None
+            self.kv = None
+
+        def forward(self, x):
+            q, k, v = torch.split(torch.nn.functional.linear(x, self.weight, self.bias), self.split_sizes, dim=-1)
+            self.kv = (k, v)
+            return q
+
+    class _PackedKVSlice(torch.nn.Module):
+        """替换 k_proj/v_proj：返回 _PackedQKVProjection 刚算出的 K 或 V。"""
+        def __init__(self, packed: "_PackedQKVProjection", index: int):
+            super().__init__()
+            self._packed = (packed,) # 用元组保存，避免重复注册为子模块
+            self.index = index
+
+        def forward(self, x):
+            return self._packed[0].kv[self.index]
+
+    class _StopOnEvent(StoppingCriteria):
+        """threading.Event 被置位后，让 generate 在下一个解码步结束。"""
+        def __init__(self, event: threading.Event):
+            self.event = event
+
+        def __call__(self, input_ids, scores, **kwargs):
+            return torch.full((input_ids.shape[0],), self.event.is_set(), dtype=torch.bool, device=input_ids.device)
+
+
+def fuse_qkv_projections(model) -> int:
+    """
+    将模型每层注意力的 Q/K/V 三个 Linear 合并为一个，batch=1 解码时每层少两次 GEMM 调用。
+    依赖注意力 forward 按 q_proj -> k_proj -> v_proj 的顺序作用于同一输入 (Qwen2/Qwen3 均如此)。
+    只处理未量化的 nn.Linear。
+
+    :return: 合并的层数。
+    """
+    fused = 0
+    for module in model.modules():
+        q, k, v = (getattr(module, name, None) for name in ("q_proj", "k_proj", "v_proj"))
+        if not all(type(m) is torch.nn.Linear for m in (q, k, v)):
+            continue
+        if (q.bias is None) != (k.bias is None) or (q.bias is None) != (v.bias is None):
+            continue
+        packed = _PackedQKVProjection(q, k, v)
+        module.q_proj = packed
+        module.k_proj = _PackedKVSlice(packed, 0)
+        module.v_proj = _PackedKVSlice(packed, 1)
+        fused += 1
+    return fused
+
+
 class LLMEngine:
     """
     Qwen3-1.7B (量化版) 模型引擎。
     负责流式对话生成。
     """
     
-    def __init__(self, model_path: str, quantization_config: Dict[str, Any] = None):
+    def __init__(self, model_path: str, quantization_config: Dict[str, Any] = None, fuse_qkv: bool = False,
+                 compile_decode: bool = False, num_threads: Optional[int] = None):
         """
         初始化 LLM 引擎。
         :param model_path: Qwen 模型文件路径。
         :param quantization_config: 量化配置（如 QLoRA, AWQ 等）。
+        :param fuse_qkv: 是否把每层的 Q/K/V 投影合并为一次矩阵乘 (仅对未量化的权重生效)。
+        :param compile_decode: 是否用 torch.compile (reduce-overhead, CUDA Graph) 编译解码步 (仅 CUDA)。
+        :param num_threads: CPU 推理的 intra-op 线程数；None 表示保持 PyTorch 默认值。
+            torch.set_num_threads 作用于整个进程 (同进程的 ASR/TTS 也受影响)，由部署方按需配置。
         """
         print(f"Initializing LLMEngine with model: {model_path}")
         self.model_path = model_path
-        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.device = "cuda" if torch is not None and torch.cuda.is_available() else "cpu"
+        self._compiled = False
+        if num_threads and torch is not None:
+            torch.set_num_threads(num_threads)
         
         try:
             # 真实部署时，这里会加载量化后的模型
             self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+            bnb_config = self._build_quantization_config(quantization_config)
+            if self.device == "cpu":
+                # 许多 CPU 没有 bf16 运算单元，且动态量化需要 float32 权重
+                torch_dtype = torch.float32
+            elif bnb_config is not None and bnb_config.load_in_8bit:
+                # 权重量化时激活仍以 16 位浮点计算 (int8 用 float16，nf4 与原精度用 bfloat16)
+                torch_dtype = torch.float16
+            else:
+                torch_dtype = torch.bfloat16
             self.model = AutoModelForCausalLM.from_pretrained(
                 model_path,
                 device_map=self.device,
-                torch_dtype=torch.bfloat16, # 假设使用 bfloat16
-                # **quantization_config # 实际传入量化配置
+                torch_dtype=torch_dtype,
+                quantization_config=bnb_config,
+                attn_implementation=self._select_attn_implementation(),
             )
+            if self.device == "cpu" and (quantization_config or {}).get("mode"):
+                self.model = self._quantize_dynamic_cpu(self.model)
+            if fuse_qkv:
+                if bnb_config is None:
+                    print(f"Fused QKV projections in {fuse_qkv_projections(self.model)} attention layers.")
+                else:
+                    print("Warning: fuse_qkv is ignored for quantized weights.")
+            if compile_decode:
+                self._compile_decode()
             self.is_mock = False
         except Exception as e:
             print(f"Failed to load LLM model ({e}). Falling back to mock implementation.")
@@ -60,9 +166,101 @@ class LLMEngine:
             "可用动作为：forward(steps), backward(steps), turn_left(degrees), turn_right(degrees), stop()."
         )
         self.history: List[Dict[str, str]] = [{"role": "system", "content": self.system_prompt}]
+        # 跨轮复用的 KV cache 及其覆盖的 token 序列 (系统提示词 + 已有对话)
+        self._kv_cache = None
+        self._kv_cache_ids = None
+        self._generate_lock = threading.Lock()
+        # 增量模板：已渲染历史的 token 序列，以及单轮 user/assistant 模板 (按占位符切分的前后缀)
+        self._prompt_ids: Optional[List[int]] = None
+        self._user_turn_tpl = None
+        self._assistant_turn_tpl = None
+        if not self.is_mock and self._build_turn_templates():
+            self._reset_prompt_ids()
+        if self._compiled:
+            self._warmup()
         print(f"LLM Engine initialized on device: {self.device}")
 
 
+    def _compile_decode(self):
+        """
+        使用静态 KV cache + torch.compile(mode="reduce-overhead") 编译模型前向：
+        形状固定后解码步被捕获为 CUDA Graph 重放，省去每个 token 的 Python 调度与 kernel 启动开销。
+        静态 cache 由 generate 自行管理，因此编译模式下不做跨轮 KV cache 复用。
+        """
+        if self.device != "cuda":
+            print(f"Warning: compile_decode requires CUDA. Skipping on {self.device}.")
+            return
+        self.model.generation_config.cache_implementation = "static"
+        self.model.forward = torch.compile(self.model.forward, mode="reduce-overhead", fullgraph=True)
+        self._compiled = True
+
+
+    def _warmup(self):
+        """在初始化阶段跑一次短生成，触发编译和 CUDA Graph 捕获，避免首轮对话承担编译延迟。"""
+        start = time.perf_counter()
+        input_text = self.tokenizer.apply_chat_template(self.history, tokenize=False, add_generation_prompt=True)
+        inputs = self.tokenizer.encode(input_text, return_tensors="pt").to(self.device)
+        self.model.generate(inputs=inputs, max_new_tokens=4, do_sample=False)
+        print(f"LLM decode step compiled in {time.perf_counter() - start:.1f}s.")
+
+
+    def _select_attn_implementation(self) -> str:
+        """
+        选择注意力实现：CUDA 上安装了 flash-attn 时使用 FlashAttention-2 (融合 softmax(QKᵀ)V，
+        减少显存读写)，否则回退到 PyTorch 的 SDPA，而不是默认的 eager 实现。
+        """
+        if self.device == "cuda" and importlib.util.find_spec("flash_attn") is not None:
+            return "flash_attention_2"
+        return "sdpa"
+
+
+    def _quantize_dynamic_cpu(self, model):
+        """
+        CPU 回退路径：对所有 nn.Linear 做 int8 动态量化 (权重 int8，激活在运行时量化)，
+        走 fbgemm (x86，支持 VNNI 时更快) 或 qnnpack (ARM) 的 int8 GEMM。
+        加速效果取决于 PyTorch 构建是否包含对应的量化后端。
+        """
+        engines = torch.backends.quantized.supported_engines
+        for engine in ("fbgemm", "qnnpack"):
+            if engine in engines:
+                torch.backends.quantized.engine = engine
+                break
+        print(f"Applying int8 dynamic quantization on CPU (engine: {torch.backends.quantized.engine}).")
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+
+
+    def _build_quantization_config(self, quantization_config: Optional[Dict[str, Any]]) -> Optional["BitsAndBytesConfig"]:
+        """
+        根据配置构建 bitsandbytes 权重量化参数。
+
+        解码阶段受限于每个 token 读取权重的带宽，int8 权重 (W8A16) 使读取量减半，
+        4-bit NF4 (W4A16) 再减半，并为 KV cache 留出显存。
+        支持的 mode：'int8'、'nf4'；未配置或为 None 时按原精度加载。
+        bitsandbytes 量化仅支持 CUDA，CPU 上忽略量化配置。
+        ('fp8' 预留给 Hopper 上的原生 FP8 检查点，目前未实现。)
+        """
+        mode = (quantization_config or {}).get("mode")
+        if mode is None:
+            return None
+        if self.device != "cuda":
+            print(f"Warning: quantization mode '{mode}' requires CUDA. Using dynamic int8 quantization on {self.device} instead.")
+            return None
+
+        if mode == "int8":
+            return BitsAndBytesConfig(
+                load_in_8bit=True,
+                llm_int8_threshold=quantization_config.get("llm_int8_threshold", 6.0),
+            )
+        if mode == "nf4":
+            return BitsAndBytesConfig(
+                load_in_4bit=True,
+                bnb_4bit_quant_type="nf4",
+                bnb_4bit_compute_dtype=torch.bfloat16,
+                bnb_4bit_use_double_quant=quantization_config.get("bnb_4bit_use_double_quant", True),
+            )
+        raise ValueError(f"Unsupported quantization mode: {mode}")
+
+
     def chat_stream(self, new_input: str) -> Generator[str, None, None]:
         """
         与 LLM 进行流式对话。
@@ -88,43 +286,170 @@ class LLMEngine:
             return
 
         # --- 真实 LLM 逻辑 ---
-        # 1. 格式化输入，应用 Qwen 的 ChatML 模板
-        # 实际 API 需要根据具体的 Qwen 模型版本调整
-        messages = self.history
-        
-        # 2. 转换为模型输入
-        input_text = self.tokenizer.apply_chat_template(
-            messages,
-            tokenize=False,
-            add_generation_prompt=True # 确保最后是 assistant 的 token
-        )
-        
-        inputs = self.tokenizer.encode(input_text, return_tensors="pt").to(self.device)
+        # 上一轮被取消时其 generate 线程可能尚未退出：各轮串行执行，避免两个线程同时读写共享的 KV cache
+        with self._generate_lock:
+            yield from self._generate_reply(new_input)
+
+
+    def _generate_reply(self, new_input: str) -> Generator[str, None, None]:
+        """chat_stream 的真实模型路径：构造输入、在后台线程中 generate 并流式产出文本。"""
+        if self._prompt_ids is not None:
+            # 1-2. 增量模板：只渲染并分词新的 user 轮次 (含生成提示)，拼接到已缓存的历史 token 之后
+            user_pre, user_post = self._user_turn_tpl
+            self._prompt_ids = self._prompt_ids + self._encode_delta(user_pre + new_input + user_post)
+            inputs = torch.tensor([self._prompt_ids], device=self.device)
+        else:
+            # 1. 格式化输入，应用 Qwen 的 ChatML 模板
+            # 实际 API 需要根据具体的 Qwen 模型版本调整
+            messages = self.history
+            
+            # 2. 转换为模型输入
+            input_text = self.tokenizer.apply_chat_template(
+                messages,
+                tokenize=False,
+                add_generation_prompt=True # 确保最后是 assistant 的 token
+            )
+            
+            inputs = self.tokenizer.encode(input_text, return_tensors="pt").to(self.device)
         
-        # 3. 流式生成
-        streamer = self.model.generate(
-            inputs,
-            max_length=512,
-            do_sample=True,
-            top_p=0.8,
-            temperature=0.7,
-            repetition_penalty=1.03,
-            # stream=True # 依赖于具体的 transformers 版本或自定义 Streamer
-        )
+        # 3. 流式生成：generate 在后台线程运行，TextIteratorStreamer 边生成边输出解码后的文本
+        # 复用上一轮的 KV cache，只需 prefill 与缓存不同的增量 token
+        cache = None if self._compiled else self._reusable_kv_cache(inputs)
+        streamer = TextIteratorStreamer(self.tokenizer, skip_prompt=True, skip_special_tokens=True)
+        stop_generation = threading.Event()
+
+        def generate():
+            try:
+                output = self.model.generate(
+                    inputs=inputs,
+                    past_key_values=cache,
+                    use_cache=True,
+                    return_dict_in_generate=True,
+                    streamer=streamer,
+                    max_new_tokens=LLM_MAX_NEW_TOKENS,
+                    do_sample=True,
+                    top_p=0.8,
+                    temperature=0.7,
+                    repetition_penalty=1.03,
+                    stopping_criteria=StoppingCriteriaList([_StopOnEvent(stop_generation)]),
+                )
+                # 记录缓存实际覆盖的 token，供下一轮做前缀比对
+                if cache is not None:
+                    self._kv_cache_ids = output.sequences[0, :cache.get_seq_length()]
+            except Exception as e:
+                print(f"LLM generation error: {e}")
+                self._kv_cache = self._kv_cache_ids = None
+                streamer.end() # 让消费端的迭代结束
+
+        generate_thread = threading.Thread(target=generate, daemon=True)
+        generate_thread.start()
         
         full_response = ""
-        # 实际中需要一个自定义 Streamer 来实现按 token 输出
-        # 这里用一个简化的同步生成并分字返回
-        generated_ids = streamer
-        
-        for token_id in generated_ids:
-            new_text = self.tokenizer.decode([token_id], skip_special_tokens=True)
-            if new_text:
-                yield new_text
-                full_response += new_text
+        finished = False
+        try:
+            for new_text in streamer:
+                if new_text:
+                    yield new_text
+                    full_response += new_text
+            finished = True
+        finally:
+            # 消费端提前关闭生成器 (本轮被取消) 时，让 generate 在下一个解码步停下并等待线程退出，
+            # 避免它继续写入下一轮要复用的 KV cache；未完成的轮次不保留缓存
+            stop_generation.set()
+            generate_thread.join()
+            if not finished:
+                self._kv_cache = self._kv_cache_ids = None
                 
         # 4. 更新历史（真实 LLM 完整回复）
         self.history.append({"role": "assistant", "content": full_response})
+        if self._prompt_ids is not None:
+            assistant_pre, assistant_post = self._assistant_turn_tpl
+            self._prompt_ids = self._prompt_ids + self._encode_delta(assistant_pre + full_response + assistant_post)
+
+
+    def _encode_delta(self, text: str) -> List[int]:
+        """对模板增量做分词 (不添加特殊 token)。"""
+        return self.tokenizer.encode(text, add_special_tokens=False)
+
+
+    def _build_turn_templates(self) -> bool:
+        """
+        用占位内容渲染一次聊天模板，推导出单轮 user 轮次 (含生成提示) 与 assistant 轮次的文本模板，
+        之后每轮只需渲染和分词增量，而不必对整个历史重新套模板。
+
+        只有在模板对历史是"只追加"的 (前缀稳定)、且分段分词与整体分词结果一致时才启用，
+        否则返回 False，继续使用整段渲染。
+        """
+        system = [{"role": "system", "content": self.system_prompt}]
+        user = {"role": "user", "content": _USER_SLOT}
+        assistant = {"role": "assistant", "content": _ASSISTANT_SLOT}
+        render = lambda messages, gen: self.tokenizer.apply_chat_template(
+            messages, tokenize=False, add_generation_prompt=gen)
+        try:
+            base = render(system, False)
+            user_open = render(system + [user], True)
+            full = render(system + [user, assistant], False)
+        except Exception as e:
+            print(f"Warning: cannot derive incremental chat template ({e}).")
+            return False
+
+        if not (user_open.startswith(base) and full.startswith(user_open)):
+            return False
+        user_delta = user_open[len(base):]
+        assistant_delta = full[len(user_open):]
+        if user_delta.count(_USER_SLOT) != 1 or assistant_delta.count(_ASSISTANT_SLOT) != 1:
+            return False
+        if self._encode_delta(base) + self._encode_delta(user_delta) != self._encode_delta(user_open):
+            return False
+
+        self._base_prompt = base
+        self._user_turn_tpl = tuple(user_delta.split(_USER_SLOT))
+        self._assistant_turn_tpl = tuple(assistant_delta.split(_ASSISTANT_SLOT))
+        return True
+
+
+    def _reset_prompt_ids(self):
+        """把增量模板的 token 序列重置为只含系统提示词。"""
+        self._prompt_ids = self._encode_delta(self._base_prompt)
+
+
+    def _reusable_kv_cache(self, input_ids) -> "DynamicCache":
+        """
+        返回可供本轮 generate 复用的 KV cache。
+
+        缓存被裁剪到与本轮输入的最长公共前缀 (通常是系统提示词 + 之前的对话)，
+        generate 只对剩余的增量 token 做 prefill。至少保留最后一个输入 token 不在缓存中。
+        输入超过 LLM_KV_CACHE_MAX_TOKENS 或没有可用缓存时返回新的空 cache。
+        """
+        n = input_ids.shape[-1]
+        if self._kv_cache is None or self._kv_cache_ids is None or n > LLM_KV_CACHE_MAX_TOKENS:
+            self._kv_cache, self._kv_cache_ids = DynamicCache(), None
+            return self._kv_cache
+
+        m = min(self._kv_cache_ids.shape[-1], n - 1)
+        mismatch = (self._kv_cache_ids[:m] != input_ids[0, :m]).nonzero()
+        common = int(mismatch[0]) if len(mismatch) else m
+        self._kv_cache.crop(common)
+        return self._kv_cache
+
+
+    async def chat_stream_async(self, new_input: str) -> AsyncIterator[str]:
+        """
+        chat_stream 的异步版本：生成在工作线程中进行，事件循环不会被模型解码阻塞。
+        Mock 模式直接用 asyncio.sleep 模拟生成延迟。
+        """
+        if self.is_mock:
+            self.history.append({"role": "user", "content": new_input})
+            print(f"Mock LLM received input: {new_input}")
+            mock_response = self._get_mock_response(new_input)
+            for char in mock_response:
+                await asyncio.sleep(0.05) # 模拟生成延迟
+                yield char
+            self.history.append({"role": "assistant", "content": mock_response})
+            return
+
+        async for chunk in iterate_in_thread(self.chat_stream, new_input):
+            yield chunk
 
 
     def _get_mock_response(self, input_text: str) -> str:
@@ -149,8 +474,13 @@ class LLMEngine:
         return self.history
         
     def clear_history(self):
-        """清空对话历史，仅保留系统提示词。"""
+        """
+        清空对话历史，仅保留系统提示词。
+        KV cache 不清空：下一轮会按公共前缀裁剪，系统提示词部分继续复用。
+        """
         self.history = [{"role": "system", "content": self.system_prompt}]
+        if self._prompt_ids is not None:
+            self._reset_prompt_ids()
         print("LLM History cleared.")
 
 
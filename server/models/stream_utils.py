@@ -0,0 +1,97 @@
+import asyncio
+import collections
+import threading
+from typing import AsyncIterator, Callable, Iterator, TypeVar
+
+T = TypeVar("T")
+
+# 队列中的结束标记 (生成器正常结束)
+_END = object()
+
+# PCM 缓冲池：每个槽的字节数 (约 0.7 秒 24kHz/16-bit 音频) 与空闲槽数上限
+PCM_POOL_SLOT_BYTES = 32 * 1024
+PCM_POOL_SLOTS = 32
+
+
+class _PumpError:
+    """包装工作线程中抛出的异常，转交给事件循环一侧重新抛出。"""
+    def __init__(self, exc: BaseException):
+        self.exc = exc
+
+
+async def iterate_in_thread(make_iter: Callable[..., Iterator[T]], *args) -> AsyncIterator[T]:
+    """
+    在工作线程中运行同步生成器，并把产出的元素以异步迭代器的形式交给事件循环。
+
+    模型推理 (LLM 解码、TTS 合成) 是阻塞调用，直接在协程里迭代会卡住事件循环，
+    使并发的 TTS/推流任务停顿。这里由线程逐个取元素，通过 call_soon_threadsafe
+    放入 asyncio.Queue，消费者 await 即可。消费者提前退出 (break/取消) 时，
+    线程在下一个元素处停止并关闭生成器。
+
+    :param make_iter: 返回同步迭代器的函数，如 engine.chat_stream。
+    :param args: 传给 make_iter 的参数。
+    """
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+    stop = threading.Event()
+
+    def pump():
+        it = make_iter(*args)
+        try:
+            for item in it:
+                if stop.is_set():
+                    break
+                loop.call_soon_threadsafe(queue.put_nowait, item)
+        except BaseException as e:
+            loop.call_soon_threadsafe(queue.put_nowait, _PumpError(e))
+            return
+        finally:
+            close = getattr(it, "close", None)
+            if close is not None:
+                close()
+        loop.call_soon_threadsafe(queue.put_nowait, _END)
+
+    loop.run_in_executor(None, pump)
+    try:
+        while True:
+            item = await queue.get()
+            if item is _END:
+                break
+            if isinstance(item, _PumpError):
+                raise item.exc
+            yield item
+    finally:
+        # 消费者提前退出时只通知线程停止，不等待它结束，避免阻塞在下一次模型调用上
+        stop.set()
+
+
+class PCMBufferPool:
+    """
+    固定大小 bytearray 的空闲链表。
+
+    TTS 每句会产生大量 PCM 块，每块一次新分配；改为从池中取出预分配的缓冲写入，
+    推送端把数据拷贝进发送消息后归还。acquire 在 TTS 工作线程中调用、release 在事件循环中调用，
+    deque 的 pop/append 是原子操作，不需要加锁。
+    """
+    def __init__(self, slot_bytes: int = PCM_POOL_SLOT_BYTES, slots: int = PCM_POOL_SLOTS):
+        self.slot_bytes = slot_bytes
+        # maxlen：归还的缓冲超过上限时丢弃最旧的，内存占用保持平稳
+        self._free = collections.deque((bytearray(slot_bytes) for _ in range(slots)), maxlen=slots)
+
+    def acquire(self, nbytes: int) -> bytearray:
+        """取出至少 nbytes 字节的缓冲；池为空或请求超过槽大小时新分配。"""
+        if nbytes > self.slot_bytes:
+            return bytearray(nbytes)
+        try:
+            return self._free.pop()
+        except IndexError:
+            return bytearray(self.slot_bytes)
+
+    def release(self, buf) -> None:
+        """归还缓冲。只回收槽大小的 bytearray，其他对象 (bytes、超大缓冲) 直接忽略。"""
+        if type(buf) is bytearray and len(buf) == self.slot_bytes:
+            self._free.append(buf)
+
+
+# 进程内共享的 PCM 缓冲池：TTS 引擎写入，PCMQueue 被读出 (已拷贝) 的数据块归还
+pcm_buffer_pool = PCMBufferPool()
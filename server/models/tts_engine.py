@@ -1,14 +1,27 @@
+import asyncio
+import threading
 import time
-from typing import Generator, List, Dict, Any
+from typing import AsyncIterator, Generator, List, Dict, Any, Tuple
+
+import numpy as np
+
+from server.models.stream_utils import iterate_in_thread, pcm_buffer_pool
+
+# 假设 TTS 的音频参数
+SAMPLE_RATE = 24000  # CosyVoice 常用采样率
+BYTES_PER_SAMPLE = 2 # 16-bit PCM, 单声道
+# 下发的 PCM 字节序固定为小端 (与小车端约定一致)，不依赖服务器主机的字节序
+PCM_DTYPE = np.dtype('<i2')
+BYTES_PER_SECOND = SAMPLE_RATE * BYTES_PER_SAMPLE # 每秒音频字节数
+
+# Mock 合成输出：固定大小的 PCM 块，模块加载时只分配一次 (bytes 不可变，可安全共享)
+MOCK_PCM_CHUNK_SIZE = 4096
+_MOCK_PCM_CHUNK = np.full(MOCK_PCM_CHUNK_SIZE // BYTES_PER_SAMPLE, 0x0101, dtype=PCM_DTYPE).tobytes()
 
 # 假设使用 CosyVoice SDK
 try:
     # 实际部署时，替换为真实的 CosyVoice Python SDK 导入
     from cosyvoice_sdk import CosyVoice
-    import numpy as np
-    
-    # 假设 TTS 的音频参数
-    SAMPLE_RATE = 24000  # CosyVoice 常用采样率
     
 except ImportError:
     print("Warning: CosyVoice SDK not found. Using mock implementation for TTS.")
@@ -17,6 +30,18 @@ except ImportError:
         def __init__(self, model_path, device):
             print(f"Mock TTS Model loaded from: {model_path} on {device}")
             
+        def _plan(self, text: str) -> Tuple[int, int, float]:
+            """估算模拟合成的 (块大小, 块数, 每块延迟)。"""
+            # 估算文本所需时间（假设 10 字/秒）
+            duration = max(0.5, len(text) / 10.0)
+            
+            # 假设每块 4096 字节
+            chunk_size = MOCK_PCM_CHUNK_SIZE
+            total_bytes = int(duration * BYTES_PER_SECOND)
+            
+            num_chunks = total_bytes // chunk_size
+            return chunk_size, num_chunks, chunk_size / BYTES_PER_SECOND
+
         def synthesize(self, text: str, voice_role: str = "default") -> Generator[bytes, None, None]:
             """
             模拟流式合成。
@@ -24,35 +49,31 @@ except ImportError:
             :return: PCM 音频数据块的生成器 (Generator[bytes])。
             """
             print(f"[Mock TTS] Synthesizing: '{text[:20]}...'")
-            
-            # 模拟 PCM 音频参数: 24000Hz, 16bit, 单声道
-            SAMPLE_RATE = 24000
-            BYTES_PER_SAMPLE = 2
-            
-            # 估算文本所需时间（假设 10 字/秒）
-            duration = max(0.5, len(text) / 10.0)
-            
-            # 每秒音频字节数
-            bytes_per_second = SAMPLE_RATE * BYTES_PER_SAMPLE * 1 
-            
-            # 假设每块 4096 字节
-            chunk_size = 4096 
-            total_bytes = int(duration * bytes_per_second)
-            
-            num_chunks = total_bytes // chunk_size
+            chunk_size, num_chunks, delay = self._plan(text)
             
             # 模拟生成过程
             for i in range(num_chunks):
-                # 模拟生成的 PCM 数据，使用随机数据代替
-                pcm_chunk = b'\x01' * chunk_size 
-                
                 # 模拟流式延迟
-                time.sleep(chunk_size / bytes_per_second)
+                time.sleep(delay)
                 
-                yield pcm_chunk
+                # 模拟生成的 PCM 数据，复用预先分配的数据块
+                yield _MOCK_PCM_CHUNK
             
             print("[Mock TTS] Synthesis finished.")
 
+        async def synthesize_async(self, text: str, voice_role: str = "default") -> AsyncIterator[bytes]:
+            """模拟流式合成的异步版本：用 asyncio.sleep 模拟延迟，不阻塞事件循环。"""
+            print(f"[Mock TTS] Synthesizing: '{text[:20]}...'")
+            chunk_size, num_chunks, delay = self._plan(text)
+            for i in range(num_chunks):
+                await asyncio.sleep(delay)
+                yield _MOCK_PCM_CHUNK
+            print("[Mock TTS] Synthesis finished.")
+
+# float32 缩放用的预分配缓冲长度 (采样点)，遇到更大的块时自动扩容
+PCM_SCRATCH_SAMPLES = 16384
+
+
 class TTSEngine:
     """
     CosyVoice (TTS) 模型引擎。
@@ -79,12 +100,16 @@ class TTSEngine:
             
         # 小车的默认音色，可能是一个预设的说话人ID
         self.default_voice_role = "petcar_assistant" 
+        # float32 -> int16 转换用的预分配缓冲，避免每块音频分配临时数组 (int16 输出写入 PCM 缓冲池)。
+        # 按线程保存：iterate_in_thread 取消时不等待泵线程退出，多个泵线程可能同时在转换
+        self._scratch_local = threading.local()
         print(f"TTS Engine initialized on device: {self.device}. Sample Rate: {SAMPLE_RATE}Hz")
 
 
     def synthesize_stream(self, text: str) -> Generator[bytes, None, None]:
         """
         将文本合成流式 PCM 音频数据。
+        每次调用都有固定的推理开销，调用方应按句 (而不是逐字/逐 token) 传入文本。
         
         :param text: 待合成的文本。
         :return: 16-bit PCM 音频数据块的生成器 (Generator[bytes])。
@@ -111,9 +136,7 @@ class TTSEngine:
             # 归一化并转换为 16-bit PCM
             if isinstance(audio_array, np.ndarray):
                 # 假设音频数组是 (-1, 1) 的 float32，转换为 int16
-                audio_array = (audio_array * 32767).astype(np.int16)
-                pcm_chunk = audio_array.tobytes()
-                yield pcm_chunk
+                yield self._float_to_pcm(audio_array)
             else:
                 # 如果 API 直接返回 bytes，则直接 yield
                 if isinstance(audio_array, bytes):
@@ -122,6 +145,44 @@ class TTSEngine:
         print("TTS synthesis stream complete.")
 
 
+    async def synthesize_stream_async(self, text: str) -> AsyncIterator[bytes]:
+        """
+        synthesize_stream 的异步版本：真实模型的合成在工作线程中进行，不阻塞事件循环；
+        Mock 模式直接使用异步的模拟合成。
+        """
+        if not text:
+            return
+
+        if self.is_mock:
+            async for pcm_chunk in self.model.synthesize_async(text, voice_role=self.default_voice_role):
+                yield pcm_chunk
+            return
+
+        async for pcm_chunk in iterate_in_thread(self.synthesize_stream, text):
+            yield pcm_chunk
+
+
+    def _float_to_pcm(self, audio_array: np.ndarray) -> memoryview:
+        """
+        将 (-1, 1) 范围的浮点音频转换为 16-bit PCM 字节。
+        缩放与裁剪写入预分配缓冲：越界采样被截断到 int16 范围而不是回绕，且不修改输入数组。
+        结果直接写入从 PCM 缓冲池取出的 bytearray，返回其上的 memoryview，由 PCMQueue 读出后归还。
+        """
+        samples = audio_array.reshape(-1)
+        n = samples.shape[0]
+        scratch = getattr(self._scratch_local, 'f32', None)
+        if scratch is None or n > scratch.shape[0]:
+            scratch = np.empty(max(n, PCM_SCRATCH_SAMPLES), dtype=np.float32)
+            self._scratch_local.f32 = scratch
+
+        f32 = scratch[:n]
+        np.multiply(samples, 32767.0, out=f32, casting='unsafe')
+        np.clip(f32, -32768.0, 32767.0, out=f32)
+        nbytes = n * BYTES_PER_SAMPLE
+        buf = pcm_buffer_pool.acquire(nbytes)
+        np.copyto(np.frombuffer(buf, dtype=PCM_DTYPE, count=n), f32, casting='unsafe')
+        return memoryview(buf)[:nbytes]
+
 if __name__ == '__main__':
     # 示例用法
     MOCK_TTS_MODEL_PATH = "/path/to/cosyvoice/model"
@@ -135,18 +196,17 @@ if __name__ == '__main__':
     pcm_stream_1 = tts_engine.synthesize_stream(test_text_1)
     
     total_bytes_1 = 0
-    start_time = time.time()
+    start_time = time.perf_counter()
     for chunk in pcm_stream_1:
         # 模拟音频数据传输和播放
         total_bytes_1 += len(chunk)
         # print(f"Received chunk of {len(chunk)} bytes.")
         
-    end_time = time.time()
+    end_time = time.perf_counter()
     
     print(f"\nTotal bytes generated: {total_bytes_1}")
     print(f"Time taken: {end_time - start_time:.2f} seconds")
     
     # 粗略估计音频时长 (假设 24kHz, 16-bit, mono)
-    # bytes_per_second = 24000 * 2 = 48000
-    estimated_duration = total_bytes_1 / 48000 if total_bytes_1 else 0
+    estimated_duration = total_bytes_1 / BYTES_PER_SECOND if total_bytes_1 else 0
     print(f"Estimated audio duration: {estimated_duration:.2f} seconds")
@@ -1,9 +1,9 @@
 import asyncio
-import re
-from typing import Dict, Any, Tuple, Optional
+from typing import AsyncIterator, Dict, Any, Generator, Tuple, Optional
 
 # 导入上一节定义的流式管理类
-from server.pipeline.streaming_manager import StreamingManager, AudioQueue, TextQueue, PCMQueue
+from server.pipeline.streaming_manager import StreamingManager, AudioQueue, TextQueue, PCMQueue, PCM_BYTES_PER_SECOND
+from server.models.stream_utils import iterate_in_thread
 # 导入模型引擎（此处使用相对导入，实际项目中需确保路径正确）
 try:
     from server.models.asr_engine import ASREngine
@@ -21,6 +21,7 @@ except ImportError:
             return None
         def end_stream(self) -> Optional[str]: return "最终识别结果。"
         def detect_wakeup_word(self, text: str) -> bool: return "小车小车" in text
+        def scan_wakeup_word(self, text: str) -> bool: return "小车小车" in text
     class LLMEngine:
         def __init__(self, *args, **kwargs): self.history = []; print("Mock LLM initialized.")
         def chat_stream(self, text: str) -> Generator[str, None, None]: 
@@ -29,19 +30,121 @@ except ImportError:
             for char in response:
                 time.sleep(0.02)
                 yield char
+        async def chat_stream_async(self, text: str) -> AsyncIterator[str]:
+            async for chunk in iterate_in_thread(self.chat_stream, text):
+                yield chunk
         def clear_history(self): self.history = []
     class TTSEngine:
         def __init__(self, *args, **kwargs): pass
+        _PCM_CHUNK = b'\x01' * 4096 # 只分配一次，所有合成调用共享
         def synthesize_stream(self, text: str) -> Generator[bytes, None, None]:
             import time
-            chunk_size = 4096
             for _ in range(5):
                 time.sleep(0.05)
-                yield b'\x01' * chunk_size
+                yield self._PCM_CHUNK
+        async def synthesize_stream_async(self, text: str) -> AsyncIterator[bytes]:
+            async for pcm_chunk in iterate_in_thread(self.synthesize_stream, text):
+                yield pcm_chunk
             
 
-# 定义 LLM 动作指令的正则模式
-ACTION_PATTERN = re.compile(r"\[ACTION:([a-zA-Z_]+\([\w\d\s,.]*\))]")
+# LLM 动作指令格式：[ACTION:name(args)]，name 只可能是小车支持的几个动作
+ACTION_TAG_OPEN = "[ACTION:"
+ACTION_TAG_MAX_LEN = 64
+_ACTIONS = ("forward", "backward", "turn_left", "turn_right", "stop")
+# 动作名互不为前缀，匹配到一个即可停止尝试
+_ACTION_CALLS = tuple(name + "(" for name in _ACTIONS)
+# 参数区除字母数字和空白外允许的字符
+_ACTION_ARG_PUNCT = frozenset("_,.")
+
+# TTS 按句合成：遇到句末标点 (且句子不短于最小长度) 或缓冲超过最大长度时送入 TTS
+TTS_SENTENCE_END = frozenset("。！？.!?\n")
+TTS_MIN_SENTENCE_CHARS = 4
+TTS_MAX_SENTENCE_CHARS = 60
+# 缓冲中有文本时等待下一块的最长时间 (秒)：LLM 停顿超过该值时不再等句末标点，直接合成
+TTS_COALESCE_TIMEOUT_S = 0.08
+
+
+def _valid_action_args(args: str) -> bool:
+    """检查动作参数区 (括号内) 是否只包含数字、字母、空白和 ',._'。"""
+    return all(c.isalnum() or c.isspace() or c in _ACTION_ARG_PUNCT for c in args)
+
+
+def find_action(buf: str, start: int = 0) -> Optional[Tuple[int, int, str]]:
+    """
+    查找 buf 中 start 之后的第一个完整动作指令。
+
+    动作名是固定的几个，因此逐步用 str.find/startswith 匹配，不需要通用正则。
+
+    :return: (指令起始位置, 指令结束位置, 动作命令如 'forward(5)')；没有则返回 None。
+    """
+    name_at_offset = len(ACTION_TAG_OPEN)
+    i = buf.find(ACTION_TAG_OPEN, start)
+    while i != -1:
+        name_at = i + name_at_offset
+        for call in _ACTION_CALLS:
+            if buf.startswith(call, name_at):
+                args_at = name_at + len(call)
+                close = buf.find(")", args_at)
+                if (close != -1 and buf.startswith("]", close + 1)
+                        and _valid_action_args(buf[args_at:close])):
+                    return i, close + 2, buf[name_at:close + 1]
+                break
+        i = buf.find(ACTION_TAG_OPEN, i + 1)
+    return None
+
+
+def _could_be_action_prefix(text: str) -> bool:
+    """判断 text (以 '[' 开头) 是否可能是一个尚未写完的动作指令。"""
+    open_len = len(ACTION_TAG_OPEN)
+    if not ACTION_TAG_OPEN.startswith(text[:open_len]):
+        return False
+    if len(text) <= open_len:
+        return True
+    if len(text) > ACTION_TAG_MAX_LEN:
+        return False
+    body = text[open_len:]
+    for name, call in zip(_ACTIONS, _ACTION_CALLS):
+        if name.startswith(body):
+            return True
+        if body.startswith(call):
+            args = body[len(call):]
+            if args.endswith(")"):
+                args = args[:-1]
+            return _valid_action_args(args)
+    return False
+
+
+def split_action_tags(pending: str) -> Tuple[str, str, Optional[str]]:
+    """
+    从流式文本中剥离动作指令。
+
+    :param pending: 尚未送往 TTS 的文本 (上次保留的尾部 + 新文本块)。
+    :return: (可以立即送往 TTS 的文本, 可能是未写完指令而需要继续保留的尾部, 解析到的第一个动作指令)。
+    """
+    if '[' not in pending:
+        # 绝大多数文本块不含指令，直接放行
+        return pending, "", None
+    parts = []
+    action = None
+    pos = 0
+    found = find_action(pending)
+    while found is not None:
+        tag_start, tag_end, command = found
+        parts.append(pending[pos:tag_start])
+        if action is None:
+            action = command
+        pos = tag_end
+        found = find_action(pending, pos)
+
+    # 指令内部不含 '['，所以未写完的指令只可能从最后一个 '[' 开始
+    rest = pending[pos:]
+    idx = rest.rfind('[')
+    if idx != -1 and _could_be_action_prefix(rest[idx:]):
+        parts.append(rest[:idx])
+        return "".join(parts), rest[idx:], action
+    parts.append(rest)
+    return "".join(parts), "", action
+
 
 class ConversationPipeline:
     """
@@ -86,21 +189,19 @@ class ConversationPipeline:
         tts_task = asyncio.create_task(self._llm_to_tts(text_out, pcm_out))
         
         try:
-            # 等待 ASR/LLM 流程完成 (即 ASR 任务完成后关闭了 TextQueue)
-            final_result = await asr_task 
+            # 2. 并发等待 ASR/LLM 与 TTS 完成 (ASR 任务会等待它启动的 LLM 任务结束)
+            final_result, _ = await asyncio.gather(asr_task, tts_task)
             action_command = final_result["action_command"]
             
-            # 2. 等待 TTS 任务完成
-            await tts_task
-            
             print("Pipeline completed successfully.")
             return True, action_command
 
         except Exception as e:
             print(f"Pipeline error: {e}")
-            # 确保流被关闭
+            # 任一阶段失败时取消其余阶段，避免另一端因队列满/无结束标记而一直等待
             asr_task.cancel()
             tts_task.cancel()
+            await asyncio.gather(asr_task, tts_task, return_exceptions=True)
             return False, None
         finally:
             self.manager.close_all() # 确保所有队列关闭
@@ -113,74 +214,86 @@ class ConversationPipeline:
         """
         full_transcription = ""
         action_command: Optional[str] = None
+        llm_task: Optional[asyncio.Task] = None
         
-        async for audio_chunk in audio_in:
-            # 1. 流式 ASR 转写
-            interim_text = self.asr_engine.transcribe_stream(audio_chunk)
-            
-            if interim_text:
-                full_transcription += interim_text
-                print(f"[ASR] Interim Text: {interim_text}")
+        try:
+            async for audio_chunk in audio_in:
+                # 1. 流式 ASR 转写
+                interim_text = self.asr_engine.transcribe_stream(audio_chunk)
                 
-                # 2. 唤醒词检测
-                if not self.conversation_active and self.asr_engine.detect_wakeup_word(full_transcription):
-                    self.conversation_active = True
-                    # 清除唤醒词，只保留命令
-                    command_text = full_transcription.replace(self.asr_engine.wakeup_word, "", 1).strip()
-                    print(f"[LLM] Wakeup triggered. Command: '{command_text}'")
-                    
-                    # 3. 触发 LLM 流式生成
-                    # 注意：这是最关键的一步，必须是非阻塞的
-                    asyncio.create_task(self._llm_chat_and_parse(command_text, text_out))
+                if interim_text:
+                    full_transcription += interim_text
+                    print(f"[ASR] Interim Text: {interim_text}")
                     
-                    # ASR 转写继续，但LLM只处理触发后的第一段完整命令。
-                    # 在简单模式下，我们假设唤醒词触发后，ASR流的后续内容是 LLM 的输入。
-                    # 简化处理：一旦唤醒词触发，ASR任务继续接收音频直到流关闭。
-                    
-        # ASR 输入流结束
-        final_text = self.asr_engine.end_stream()
-        if final_text and not self.conversation_active:
-            print(f"[ASR] Final result (Not triggered): {final_text}")
-            
-        # 4. 如果 LLM 任务已经启动，它会自己关闭 text_out 队列。
-        # 如果 ASR 结束了但 LLM 没有被触发，我们也要关闭 TextQueue 以结束 TTS 任务
-        if not self.conversation_active:
-            await text_out.put("对不起，我没有听到唤醒词，请再说一次。")
-            text_out.close()
+                    # 2. 唤醒词检测
+                    # 只扫描新的转写片段 (引擎内部保留上一段的尾部)，不重复扫描累计的全文
+                    if not self.conversation_active and self.asr_engine.scan_wakeup_word(interim_text):
+                        self.conversation_active = True
+                        # 清除唤醒词，只保留命令
+                        command_text = full_transcription.replace(self.asr_engine.wakeup_word, "", 1).strip()
+                        print(f"[LLM] Wakeup triggered. Command: '{command_text}'")
+                        
+                        # 3. 触发 LLM 流式生成
+                        # 注意：这是最关键的一步，必须是非阻塞的；任务被记录下来，ASR 结束后等待其结果
+                        llm_task = asyncio.create_task(self._llm_chat_and_parse(command_text, text_out))
+                        
+                        # ASR 转写继续，但LLM只处理触发后的第一段完整命令。
+                        # 在简单模式下，我们假设唤醒词触发后，ASR流的后续内容是 LLM 的输入。
+                        # 简化处理：一旦唤醒词触发，ASR任务继续接收音频直到流关闭。
+                        
+            # ASR 输入流结束
+            final_text = self.asr_engine.end_stream()
+            if final_text and not self.conversation_active:
+                print(f"[ASR] Final result (Not triggered): {final_text}")
+                
+            # 4. 如果 LLM 任务已经启动，它会自己关闭 text_out 队列，这里等待它解析出的动作指令。
+            # 如果 ASR 结束了但 LLM 没有被触发，我们也要关闭 TextQueue 以结束 TTS 任务
+            if llm_task is not None:
+                action_command = await llm_task
+            else:
+                await text_out.put("对不起，我没有听到唤醒词，请再说一次。")
+                text_out.close()
+        finally:
+            if llm_task is None:
+                text_out.close() # 异常退出时也要让 TTS 任务结束
+            elif not llm_task.done():
+                llm_task.cancel()
             
         return {"final_transcription": full_transcription, "action_command": action_command}
 
 
-    async def _llm_chat_and_parse(self, command_text: str, text_out: TextQueue):
+    async def _llm_chat_and_parse(self, command_text: str, text_out: TextQueue) -> Optional[str]:
         """
         处理 LLM 阶段：流式生成回复，解析动作指令，并将回复文本传给 TTS。
+
+        :return: 回复中解析到的第一个动作指令，没有则为 None。
         """
         full_response = ""
         action_command: Optional[str] = None
+        pending = "" # 暂不送往 TTS 的尾部 (可能是未写完的动作指令)
         
-        # 1. 获取 LLM 的流式生成器
-        llm_stream = self.llm_engine.chat_stream(command_text)
+        # 1. 获取 LLM 的异步流 (生成在工作线程中进行，不阻塞事件循环)
+        llm_stream = self.llm_engine.chat_stream_async(command_text)
         
         # 2. 异步处理 LLM 输出
         try:
-            # 由于 llm_stream 是同步生成器，我们需要在一个单独的线程/进程中运行它
-            # 或者将其包装成异步迭代器。这里我们用一个简单的循环来模拟异步处理。
-            for chunk in llm_stream:
+            async for chunk in llm_stream:
                 full_response += chunk
                 
                 # 3. 实时解析动作指令 (指令可能在回复的开头、中间或结尾)
-                match = ACTION_PATTERN.search(full_response)
-                if match and not action_command:
-                    action_command = match.group(1)
+                # 只扫描保留的尾部 + 新块；指令写完前先扣住，不让 TTS 读出来
+                clean_chunk, pending, found = split_action_tags(pending + chunk)
+                if found and not action_command:
+                    action_command = found
                     print(f"[LLM] ACTION PARSED: {action_command}")
-                    # 提取指令后，我们把指令从 LLM 文本中移除，不让 TTS 读出来
-                    clean_chunk = re.sub(ACTION_PATTERN, "", chunk)
-                else:
-                    clean_chunk = chunk
                 
                 # 4. 将清理后的文本块传给 TTS (通过 text_out 队列)
                 if clean_chunk:
                     await text_out.put(clean_chunk)
+
+            # 流结束时仍未写完的 "指令" 只是普通文本
+            if pending:
+                await text_out.put(pending)
                     
         except Exception as e:
             print(f"LLM streaming error: {e}")
@@ -190,28 +303,42 @@ class ConversationPipeline:
             print(f"[LLM] Full Response: {full_response.strip()}")
             print("[LLM] TextQueue closed.")
 
+        return action_command
+
 
     async def _llm_to_tts(self, text_in: TextQueue, pcm_out: PCMQueue):
         """
         处理 TTS 阶段：从 LLM 文本流实时合成 PCM 音频。
         """
         full_text_to_synthesize = ""
+        buf = "" # 尚未凑成完整句子的文本
         
-        # 1. 从 TextQueue 获取完整的文本流
-        async for text_chunk in text_in:
+        # 1. 从 TextQueue 获取文本流，把排队中的多个文本块合并进缓冲
+        while True:
+            try:
+                if buf:
+                    # 缓冲中已有文本：只等待一小段时间，避免 LLM 停顿时句子迟迟不送入 TTS
+                    text_chunk = await asyncio.wait_for(text_in.get(), timeout=TTS_COALESCE_TIMEOUT_S)
+                else:
+                    text_chunk = await text_in.get()
+            except asyncio.TimeoutError:
+                if len(buf) >= TTS_MIN_SENTENCE_CHARS:
+                    await self._synthesize_to_queue(buf, pcm_out)
+                    buf = ""
+                continue
+            if text_chunk is None:
+                break
             full_text_to_synthesize += text_chunk
-            # 2. 将文本块传入 TTS 引擎进行流式合成
-            
-            # NOTE: 实际 CosyVoice SDK 需要设计为可以接收持续的文本输入
-            # 并根据标点符号或固定时间间隔进行分段合成。
-            # 在简化实现中，我们假设 TTS 引擎可以处理累计的文本，并实时流出 PCM。
-            
-            # 假设 TTS 引擎是流式生成器
-            pcm_stream = self.tts_engine.synthesize_stream(text_chunk) 
-            
-            # 3. 将 TTS 生成的 PCM 块放入 PCMQueue
-            for pcm_chunk in pcm_stream:
-                await pcm_out.put(pcm_chunk)
+            buf += text_chunk
+
+            # 2. 按句送入 TTS：每次合成调用都有固定开销，逐字合成还会打断韵律
+            sentence, buf = self._take_sentence(buf)
+            if sentence:
+                await self._synthesize_to_queue(sentence, pcm_out)
+
+        # 3. 文本流结束，合成剩余的不完整句子
+        if buf.strip():
+            await self._synthesize_to_queue(buf, pcm_out)
                 
         # 4. 文本流结束，TTS 完成所有合成后，关闭 PCMQueue
         pcm_out.close()
@@ -219,6 +346,34 @@ class ConversationPipeline:
         print("[TTS] PCMQueue closed.")
 
 
+    @staticmethod
+    def _take_sentence(buf: str) -> Tuple[str, str]:
+        """
+        从缓冲中切出可合成的部分：截至最后一个句末标点，或超长时整段切出。
+        :return: (待合成文本, 剩余缓冲)；不足一句时待合成文本为空。
+        """
+        for i in range(len(buf) - 1, -1, -1):
+            if buf[i] in TTS_SENTENCE_END:
+                if i + 1 >= TTS_MIN_SENTENCE_CHARS:
+                    return buf[:i + 1], buf[i + 1:]
+                break
+        if len(buf) >= TTS_MAX_SENTENCE_CHARS:
+            return buf, ""
+        return "", buf
+
+    async def _synthesize_to_queue(self, text: str, pcm_out: PCMQueue):
+        """
+        合成一段文本，并将 TTS 生成的 PCM 块放入 PCMQueue (合成不阻塞事件循环)。
+        PCMQueue 已被关闭 (推送端断开) 时不再合成：剩余文本仍会被读取，LLM 不会因文本队列写满而阻塞。
+        """
+        if pcm_out.is_finished:
+            return
+        async for pcm_chunk in self.tts_engine.synthesize_stream_async(text):
+            await pcm_out.put(pcm_chunk)
+            if pcm_out.is_finished:
+                break
+
+
     def get_pcm_output_queue(self) -> PCMQueue:
         """提供给 API Server 用于推送音频流到客户端的接口。"""
         queues = self.manager.get_queues()
@@ -263,10 +418,12 @@ if __name__ == '__main__':
         """模拟客户端播放音频"""
         print("\n[Mock Client] Starting PCM playback download...")
         total_bytes = 0
-        async for chunk in pcm_queue:
-            total_bytes += len(chunk)
+        while await pcm_queue.wait_readable():
+            # 一次取走所有已到达的 PCM 数据，每批只 await 一次
+            pcm_data = pcm_queue.drain_available()
+            total_bytes += len(pcm_data)
             # 模拟播放
-            await asyncio.sleep(len(chunk) / 48000)
+            await asyncio.sleep(len(pcm_data) / PCM_BYTES_PER_SECOND)
         print(f"[Mock Client] Playback finished. Total PCM bytes received: {total_bytes}.")
 
     async def main_test():
@@ -1,42 +1,156 @@
 import asyncio
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Union
+
+from server.models.stream_utils import PCMBufferPool, pcm_buffer_pool
+
+# 音频数据块：bytes 或任意连续缓冲 (bytearray/memoryview)，队列只传递引用，不复制
+PCMChunk = Union[bytes, bytearray, memoryview]
 
 # 定义音频参数常量 (与 ASR/TTS 引擎保持一致)
 AUDIO_SAMPLE_RATE = 16000 # ASR 输入常用 16kHz
 PCM_SAMPLE_RATE = 24000   # TTS 输出常用 24kHz
 BYTES_PER_SAMPLE = 2      # 16-bit PCM
+PCM_BYTES_PER_SECOND = PCM_SAMPLE_RATE * BYTES_PER_SAMPLE # TTS 输出每秒字节数，用于播放节奏
 
-class AudioQueue:
+# 队列容量：消费者变慢时 put 在此处等待 (背压)，而不是在内存中无限堆积
+AUDIO_QUEUE_MAXSIZE = 32  # 约 4 秒上行音频 (4KB 块, 16kHz/16-bit)
+TEXT_QUEUE_MAXSIZE = 64
+PCM_QUEUE_MAXSIZE = 16
+
+class _ChunkQueue:
     """
-    用于缓存客户端上传的原始音频 PCM 数据块的异步队列。
-    作为 ASR 引擎的输入来源。
+    AudioQueue/PCMQueue 共用的字节块队列 (单生产者/单消费者)。
+    数据块以 memoryview 形式存入容量为 2 的幂的环形缓冲，只传递引用；read() 可跨块取出指定字节数，
+    只在最后拼接时复制一次。队列按块数有界 (maxsize 向上取整到 2 的幂)，满时 put 会等待。
+    只有生产者移动 _tail、只有消费者移动 _head，不需要加锁。
+    指定 pool 时，read 拷贝完的数据块所在的池缓冲会被归还。
     """
-    def __init__(self):
-        # 存储 bytes 数据块
-        self.queue = asyncio.Queue()
+    def __init__(self, maxsize: int, pool: Optional[PCMBufferPool] = None):
+        capacity = 1 << max(maxsize - 1, 0).bit_length()
+        self._ring: List[Optional[memoryview]] = [None] * capacity
+        self._mask = capacity - 1
+        self._head = 0 # 下一个读取位置 (单调递增，取模由 _mask 完成)
+        self._tail = 0 # 下一个写入位置
+        self._pool = pool
+        self._size = 0 # 队列中的字节总数
+        self._waiter: Optional[asyncio.Future] = None # 等待数据的消费者
+        self._putter: Optional[asyncio.Future] = None # 等待空位的生产者
         self.is_finished = False
-        print("AudioQueue initialized.")
 
-    async def put(self, chunk: bytes):
-        """将音频数据块放入队列。"""
+    @staticmethod
+    def _wakeup(fut: Optional[asyncio.Future]):
+        if fut is not None and not fut.done():
+            fut.set_result(None)
+
+    def _append(self, chunk: PCMChunk):
+        mv = memoryview(chunk).cast("B")
+        if mv.nbytes:
+            self._ring[self._tail & self._mask] = mv
+            self._tail += 1
+            self._size += mv.nbytes
+            self._wakeup(self._waiter)
+
+    def _popleft(self) -> memoryview:
+        i = self._head & self._mask
+        mv = self._ring[i]
+        self._ring[i] = None # 释放引用，池缓冲才能被回收
+        self._head += 1
+        self._size -= mv.nbytes
+        self._wakeup(self._putter)
+        return mv
+
+    def put_nowait(self, chunk: PCMChunk):
+        """非阻塞地放入数据块，队列已满时抛出 asyncio.QueueFull。"""
+        if self.is_finished:
+            return
+        if self._tail - self._head > self._mask:
+            raise asyncio.QueueFull
+        self._append(chunk)
+
+    async def put(self, chunk: PCMChunk):
+        """放入数据块，队列已满时等待消费者取走数据。"""
+        while not self.is_finished and self._tail - self._head > self._mask:
+            self._putter = asyncio.get_running_loop().create_future()
+            try:
+                await self._putter
+            finally:
+                self._putter = None
+        # 等待期间队列被关闭时丢弃数据块
         if not self.is_finished:
-            await self.queue.put(chunk)
-            
-    async def get(self) -> bytes:
-        """从队列中取出音频数据块。"""
-        return await self.queue.get()
+            self._append(chunk)
+
+    async def wait_readable(self) -> bool:
+        """等待队列中有数据；流已结束且数据已取完时返回 False。"""
+        while self._head == self._tail:
+            if self.is_finished:
+                return False
+            self._waiter = asyncio.get_running_loop().create_future()
+            try:
+                await self._waiter
+            finally:
+                self._waiter = None
+        return True
+
+    async def get(self) -> Optional[memoryview]:
+        """取出一个数据块 (memoryview)，流结束后返回 None。"""
+        if not await self.wait_readable():
+            return None
+        return self._popleft()
+
+    def get_nowait(self) -> Optional[memoryview]:
+        """非阻塞地取出数据块，流结束后返回 None，队列暂时为空时抛出 asyncio.QueueEmpty。"""
+        if self._head != self._tail:
+            return self._popleft()
+        if self.is_finished:
+            return None
+        raise asyncio.QueueEmpty
 
-    def task_done(self):
-        """通知队列数据块已被处理。"""
-        self.queue.task_done()
+    def read_nowait(self, n: int) -> bytes:
+        """跨块取出已到达的最多 n 字节，不足一块的部分留在队列中。"""
+        parts = []
+        consumed = 0 # parts 中前 consumed 个是被完整取出的数据块
+        while n > 0 and self._head != self._tail:
+            mv = self._ring[self._head & self._mask]
+            if mv.nbytes <= n:
+                parts.append(self._popleft())
+                consumed += 1
+                n -= mv.nbytes
+            else:
+                parts.append(mv[:n])
+                self._ring[self._head & self._mask] = mv[n:]
+                self._size -= n
+                n = 0
+        data = b"".join(parts)
+        if self._pool is not None:
+            # 数据已拷贝进 data，底层缓冲可以交给下一次合成复用
+            for mv in parts[:consumed]:
+                self._pool.release(mv.obj)
+        return data
+
+    def drain_available(self) -> bytes:
+        """一次取出队列中已到达的全部数据 (拼接为一个 bytes)，队列为空时返回 b""。"""
+        return self.read_nowait(self._size)
+
+    async def read(self, n: int) -> bytes:
+        """等待至少有一个数据块后取出最多 n 字节，流结束后返回 b""。"""
+        if not await self.wait_readable():
+            return b""
+        return self.read_nowait(n)
+
+    @property
+    def nbytes(self) -> int:
+        """队列中尚未取出的字节数。"""
+        return self._size
+
+    def is_empty(self) -> bool:
+        """检查队列是否为空。"""
+        return self._head == self._tail
 
     def close(self):
-        """标记输入流已结束，防止新的数据进入。"""
+        """标记流已结束：不再接收新数据，消费者取完剩余数据后 get 返回 None。"""
         self.is_finished = True
-        # 放入一个特殊标记，让消费者知道流已结束
-        # None 作为流结束标记是常用的异步队列模式
-        self.queue.put_nowait(None)
-        print("AudioQueue closed and marked as finished.")
+        self._wakeup(self._waiter)
+        self._wakeup(self._putter)
 
     def __aiter__(self):
         return self
@@ -48,9 +162,28 @@ class AudioQueue:
             raise StopAsyncIteration
         return chunk
 
-    def is_empty(self) -> bool:
-        """检查队列是否为空。"""
-        return self.queue.empty()
+
+class AudioQueue(_ChunkQueue):
+    """
+    用于缓存客户端上传的原始音频 PCM 数据块的异步队列。
+    作为 ASR 引擎的输入来源。
+    """
+    def __init__(self, maxsize: int = AUDIO_QUEUE_MAXSIZE):
+        super().__init__(maxsize)
+        print("AudioQueue initialized.")
+
+    async def put_many(self, chunks: List[PCMChunk]):
+        """批量放入音频数据块：队列未满时直接 put_nowait，不为每块单独挂起。"""
+        for chunk in chunks:
+            try:
+                self.put_nowait(chunk)
+            except asyncio.QueueFull:
+                await self.put(chunk)
+
+    def close(self):
+        """标记输入流已结束，防止新的数据进入。"""
+        super().close()
+        print("AudioQueue closed and marked as finished.")
 
 
 class TextQueue:
@@ -58,9 +191,9 @@ class TextQueue:
     用于缓存 LLM 的流式文本输出的异步队列。
     作为 TTS 引擎的输入来源。
     """
-    def __init__(self):
-        # 存储 str 文本块
-        self.queue = asyncio.Queue()
+    def __init__(self, maxsize: int = TEXT_QUEUE_MAXSIZE):
+        # 存储 str 文本块 (有界，队列满时 put 会等待)
+        self.queue = asyncio.Queue(maxsize=maxsize)
         self.is_finished = False
         print("TextQueue initialized.")
 
@@ -69,14 +202,20 @@ class TextQueue:
         if not self.is_finished:
             await self.queue.put(text_chunk)
             
-    async def get(self) -> str:
-        """从队列中取出文本块。"""
+    async def get(self) -> Optional[str]:
+        """从队列中取出文本块，流结束后返回 None。"""
+        if self.is_finished and self.queue.empty():
+            return None
         return await self.queue.get()
 
     def close(self):
         """标记文本流已结束，放入特殊标记。"""
         self.is_finished = True
-        self.queue.put_nowait(None)
+        try:
+            self.queue.put_nowait(None)
+        except asyncio.QueueFull:
+            # 队列已满说明消费者没有阻塞在 get 上，它取完剩余数据后 get 会根据 is_finished 返回 None
+            pass
         print("TextQueue closed and marked as finished.")
 
     def __aiter__(self):
@@ -90,43 +229,22 @@ class TextQueue:
         return chunk
 
 
-class PCMQueue:
+class PCMQueue(_ChunkQueue):
     """
     用于缓存 TTS 合成后的 PCM 音频数据块的异步队列。
     作为 WebSocket 服务端推送给小车客户端的输出来源。
     """
-    def __init__(self):
-        # 存储 bytes 数据块
-        self.queue = asyncio.Queue()
-        self.is_finished = False
+    def __init__(self, maxsize: int = PCM_QUEUE_MAXSIZE, pool: Optional[PCMBufferPool] = pcm_buffer_pool):
+        # TTS 快于推送时 put 会等待；推送端读出的池缓冲归还给共享的 PCM 缓冲池
+        super().__init__(maxsize, pool)
         self.queue_id = id(self)
         print(f"PCMQueue (ID: {self.queue_id}) initialized.")
 
-    async def put(self, pcm_chunk: bytes):
-        """将 PCM 音频数据块放入队列。"""
-        if not self.is_finished:
-            await self.queue.put(pcm_chunk)
-            
-    async def get(self) -> bytes:
-        """从队列中取出 PCM 音频数据块。"""
-        return await self.queue.get()
-
     def close(self):
-        """标记 PCM 流已结束，放入特殊标记。"""
-        self.is_finished = True
-        self.queue.put_nowait(None)
+        """标记 PCM 流已结束。"""
+        super().close()
         print(f"PCMQueue (ID: {self.queue_id}) closed and marked as finished.")
 
-    def __aiter__(self):
-        return self
-
-    async def __anext__(self):
-        """实现异步迭代器协议。"""
-        chunk = await self.get()
-        if chunk is None:
-            raise StopAsyncIteration
-        return chunk
-
 
 class StreamingManager:
     """
@@ -139,24 +257,26 @@ class StreamingManager:
         self.llm_text_out_queue: Optional[TextQueue] = None
         # TTS 输出 / Car 播放队列
         self.pcm_out_queue: Optional[PCMQueue] = None
+        # get_queues 返回的字典，在创建队列时构建一次，关闭时作废
+        self._queues: Optional[Dict[str, Any]] = None
         
     def start_new_conversation(self):
         """启动新一轮对话流，创建所有新的队列。"""
         self.audio_in_queue = AudioQueue()
         self.llm_text_out_queue = TextQueue()
         self.pcm_out_queue = PCMQueue()
+        self._queues = {
+            "audio_in": self.audio_in_queue,
+            "text_out": self.llm_text_out_queue,
+            "pcm_out": self.pcm_out_queue,
+        }
         print("StreamingManager started a new conversation stream.")
 
     def get_queues(self) -> Dict[str, Any]:
         """返回所有活动队列，供 Conversation Pipeline 使用。"""
-        if not all([self.audio_in_queue, self.llm_text_out_queue, self.pcm_out_queue]):
+        if self._queues is None:
             raise RuntimeError("Conversation streams not initialized. Call start_new_conversation().")
-            
-        return {
-            "audio_in": self.audio_in_queue,
-            "text_out": self.llm_text_out_queue,
-            "pcm_out": self.pcm_out_queue,
-        }
+        return self._queues
 
     def close_all(self):
         """关闭所有队列。"""
@@ -170,6 +290,7 @@ class StreamingManager:
         self.audio_in_queue = None
         self.llm_text_out_queue = None
         self.pcm_out_queue = None
+        self._queues = None
         print("StreamingManager closed all queues.")
 
 
@@ -220,14 +341,16 @@ if __name__ == '__main__':
             print("[Car Upload] Finished and closed AudioQueue.")
             
         # 4. 模拟 Car 客户端音频播放
-        async def mock_car_playback():
+        async def mock_car_playback(_bps=PCM_BYTES_PER_SECOND):
             print("\n[Car Playback] Started.")
             total_bytes_played = 0
-            async for pcm_chunk in pcm_out:
-                total_bytes_played += len(pcm_chunk)
+            # 每次唤醒取走所有已到达的数据块，而不是每块 await 一次
+            while await pcm_out.wait_readable():
+                pcm_data = pcm_out.drain_available()
+                total_bytes_played += len(pcm_data)
                 # 模拟播放延迟
-                await asyncio.sleep(len(pcm_chunk) / (PCM_SAMPLE_RATE * BYTES_PER_SAMPLE))
-                # print(f"[Car Playback] Played {len(pcm_chunk)} bytes.")
+                await asyncio.sleep(len(pcm_data) / _bps)
+                # print(f"[Car Playback] Played {len(pcm_data)} bytes.")
             print(f"[Car Playback] Finished. Total bytes played: {total_bytes_played}.")
 
         # 启动所有任务
@@ -1,6 +1,7 @@
 import asyncio
 import sys
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 # 将项目根目录添加到 Python 路径，以便导入模块
 # 假设 run.py 位于 petcar-ai/server/
@@ -26,41 +27,52 @@ except ImportError as e:
     sys.exit(1)
 
 
+def _load_engine(name: str, factory, **kwargs):
+    """在工作线程中创建单个模型引擎；失败时打印错误并返回 None，不影响其他引擎。"""
+    try:
+        return factory(**kwargs)
+    except Exception as e:
+        print(f"ERROR: Failed to initialize {name} Engine: {e}")
+        return None
+
+
 def initialize_models():
     """
     初始化所有 AI 模型引擎。
+    三个模型的加载都以磁盘读取和设备初始化为主，放入线程池并行加载，启动耗时从三者之和降为最长的一个。
     """
     print("\n--- 1. Initializing AI Models ---")
     
-    # 1. ASR Engine
-    try:
-        asr_engine = ASREngine(
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        # 1. ASR Engine
+        asr_future = executor.submit(
+            _load_engine, "ASR", ASREngine,
             model_path=ASR_CONFIG["model_path"],
-            wakeup_word=ASR_CONFIG["wakeup_word"]
+            wakeup_word=ASR_CONFIG["wakeup_word"],
+            gate_rms_threshold=ASR_CONFIG["gate_rms_threshold"],
+            gate_hangover_chunks=ASR_CONFIG["gate_hangover_chunks"]
         )
-    except Exception as e:
-        print(f"ERROR: Failed to initialize ASR Engine: {e}")
-        asr_engine = None
 
-    # 2. LLM Engine
-    try:
-        llm_engine = LLMEngine(
+        # 2. LLM Engine
+        llm_future = executor.submit(
+            _load_engine, "LLM", LLMEngine,
             model_path=LLM_CONFIG["model_path"],
-            quantization_config=LLM_CONFIG["quantization_config"]
+            quantization_config=LLM_CONFIG["quantization_config"],
+            fuse_qkv=LLM_CONFIG["fuse_qkv"],
+            compile_decode=LLM_CONFIG["compile_decode"],
+            num_threads=LLM_CONFIG["num_threads"]
         )
-    except Exception as e:
-        print(f"ERROR: Failed to initialize LLM Engine: {e}")
-        llm_engine = None
 
-    # 3. TTS Engine
-    try:
-        tts_engine = TTSEngine(
+        # 3. TTS Engine
+        tts_future = executor.submit(
+            _load_engine, "TTS", TTSEngine,
             model_path=TTS_CONFIG["model_path"],
             device=TTS_CONFIG["device"]
         )
-    except Exception as e:
-        print(f"ERROR: Failed to initialize TTS Engine: {e}")
-        tts_engine = None
+
+    asr_engine = asr_future.result()
+    llm_engine = llm_future.result()
+    tts_engine = tts_future.result()
         
     if not all([asr_engine, llm_engine, tts_engine]):
         print("Warning: One or more critical AI models failed to load. The system may run in partial or mock mode.")
@@ -111,4 +123,12 @@ if __name__ == '__main__':
     if 'cuda' in DEVICE:
         print(f"*** Running on GPU: {DEVICE} ***")
     
+    # 可选：使用 uvloop 替换默认事件循环，提升 WebSocket 控制/音频流的吞吐
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        print("Using uvloop event loop.")
+    except ImportError:
+        pass
+
     main()